@@ -0,0 +1,105 @@
+# AUTOCOMPLETE.PY keeps in-memory prefix indexes of the type, move and
+# category names of the Pokemon Types app, used to suggest names while they
+# are typed in the pokemon forms.
+
+import time
+import threading
+from bisect import bisect_left, insort
+from database_setup import Type, Move, Category
+
+
+# Tables whose names can be looked up, by kind
+AUTOCOMPLETE_TABLES = {
+    'type': Type,
+    'move': Move,
+    'category': Category
+    }
+
+# Most suggestions returned at a time
+MAX_SUGGESTIONS = 10
+
+
+class PrefixIndex():
+    """Sorted list of names searched by prefix with a binary search, so a
+       lookup takes O(log n) plus the number of matches returned. Matching
+       ignores case.
+    """
+
+    def __init__(self, names=()):
+        # (lowercase name, name) pairs
+        self.entries = sorted(set((name.lower(), name) for name in names))
+
+    def add(self, name):
+        """Add the name if not indexed yet"""
+
+        entry = (name.lower(), name)
+        position = bisect_left(self.entries, entry)
+        if position == len(self.entries) or self.entries[position] != entry:
+            insort(self.entries, entry)
+
+    def search(self, prefix, limit=MAX_SUGGESTIONS):
+        """Return up to limit names starting with the prefix, in
+           alphabetical order
+
+           Args: prefix (str): Ex. 'th'
+           Return value: (list): Ex. ['Thunder', 'Thunderbolt']
+        """
+
+        prefix = prefix.lower()
+        entries = self.entries
+
+        names = []
+        position = bisect_left(entries, (prefix,))
+        while (len(names) < limit and position < len(entries) and
+               entries[position][0].startswith(prefix)):
+            names.append(entries[position][1])
+            position += 1
+
+        return names
+
+
+class AutocompleteIndexes():
+    """Prefix index of each kind of name. Names added by this process are
+       applied at once. The indexes are loaded again from the database after
+       a job deleted names, and after max_age seconds to pick up names
+       changed by other worker processes.
+    """
+
+    def __init__(self, max_age=30):
+        self.max_age = max_age
+        self.indexes = {}
+        self.loaded = 0
+        self.lock = threading.Lock()
+
+    def load(self, session):
+        """Load the indexes of all kinds from the database"""
+
+        indexes = {}
+        for kind, table in AUTOCOMPLETE_TABLES.items():
+            indexes[kind] = PrefixIndex(
+                name for name, in session.query(table.name))
+
+        with self.lock:
+            self.indexes = indexes
+            self.loaded = time.time()
+
+    def clear(self):
+        """Load the indexes from the database again on the next search"""
+
+        with self.lock:
+            self.loaded = 0
+
+    def search(self, kind, prefix, session, limit=MAX_SUGGESTIONS):
+        """Return up to limit names of the kind starting with the prefix"""
+
+        if time.time() - self.loaded > self.max_age:
+            self.load(session)
+
+        return self.indexes[kind].search(prefix, limit)
+
+    def add(self, kind, name):
+        """Index a name added to the database"""
+
+        with self.lock:
+            if kind in self.indexes:
+                self.indexes[kind].add(name)
@@ -0,0 +1,525 @@
+# BENCHMARK.PY measures the cost of performance-sensitive parts of the Pokemon
+# Types app. It runs offline against generated data, the local static files
+# and local stub servers.
+#
+# Usage: python benchmark.py [benchmark name ...]
+# All benchmarks are run when no name is given.
+
+import os
+import sys
+import json
+import time
+import statistics
+
+
+def time_call(function, repeat=20):
+    """Return the median time in milliseconds of calling the function"""
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return statistics.median(timings)
+
+
+def make_catalog_json(count):
+    """Generate a full-catalog JSON body shaped like /pokemon/json"""
+
+    pokemon_list = []
+    for id in range(1, count + 1):
+        pokemon_list.append({
+            'id': id,
+            'name': 'Pokemon %s' % id,
+            'pokedex_id': id,
+            'description': ('Generated pokemon number %s used to measure '
+                            'the cost of serving the catalog.' % id),
+            'image': ('https://assets.pokemon.com/assets/cms2/img/pokedex/'
+                      'full/%03d.png' % id),
+            'height': '2\'4"',
+            'weight': 15.2,
+            'is_mythical': False,
+            'is_legendary': id % 50 == 0,
+            'evolves_from': '',
+            'evolves_to': 'Pokemon %s' % (id + 1),
+            'types': 'Grass, Poison',
+            'weaknesses': 'Fire, Flying, Ice, Psychic',
+            'moves': 'Tackle, Growl, Leech Seed, Vine Whip, Razor Leaf',
+            'category': 'Seed'
+            })
+
+    return json.dumps({'Pokemon': pokemon_list}).encode('utf-8')
+
+
+#
+# BENCHMARKS
+#
+def benchmark_compression():
+    """CPU cost and size savings of each content encoding"""
+
+    from compression import compress, get_supported_encodings
+
+    bodies = [('catalog json (100)', make_catalog_json(100)),
+              ('catalog json (1000)', make_catalog_json(1000))]
+
+    static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'static')
+    for filename in sorted(os.listdir(static_folder)):
+        with open(os.path.join(static_folder, filename), 'rb') as static_file:
+            bodies.append(('static/%s' % filename, static_file.read()))
+
+    print('%-22s %-6s %10s %10s %8s %10s' % (
+        'body', 'enc', 'bytes', 'encoded', 'ratio', 'ms'))
+
+    for name, data in bodies:
+        for encoding in get_supported_encodings():
+            compressed = compress(data, encoding)
+            milliseconds = time_call(lambda: compress(data, encoding))
+            print('%-22s %-6s %10d %10d %8.2f %10.3f' % (
+                name, encoding, len(data), len(compressed),
+                len(compressed) / len(data), milliseconds))
+
+
+def benchmark_login():
+    """Token verification latency of the log-in flow against a local stub
+       OAuth server, with fresh connections, pooled connections and cached
+       token info
+    """
+
+    import threading
+    import requests
+    from concurrent.futures import ThreadPoolExecutor
+    from oauth_stub import create_stub_server
+    import google_auth
+
+    server = create_stub_server(latency=0.002)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://localhost:%s' % server.server_address[1]
+    google_auth.TOKENINFO_URL = base_url + '/oauth2/v1/tokeninfo'
+    google_auth.USERINFO_URL = base_url + '/oauth2/v1/userinfo'
+
+    def verify_unpooled(token):
+        requests.get(google_auth.TOKENINFO_URL,
+                     params={'access_token': token}).json()
+        requests.get(google_auth.USERINFO_URL,
+                     params={'access_token': token, 'alt': 'json'}).json()
+
+    def verify_pooled(token):
+        google_auth.token_info_cache.discard(token)
+        google_auth.user_info_cache.discard(token)
+        google_auth.get_token_info(token)
+        google_auth.get_user_info(token)
+
+    def verify_cached(token):
+        google_auth.get_token_info(token)
+        google_auth.get_user_info(token)
+
+    def run(verify, concurrency, logins=200):
+        def timed_login(number):
+            start = time.perf_counter()
+            verify('stub-%s' % (number % 20))
+            return (time.perf_counter() - start) * 1000
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            timings = sorted(executor.map(timed_login, range(logins)))
+
+        return (statistics.median(timings),
+                timings[int(len(timings) * 0.95) - 1])
+
+    print('%-10s %12s %10s %10s' % ('client', 'concurrency', 'p50 ms',
+                                    'p95 ms'))
+    for name, verify in [('unpooled', verify_unpooled),
+                         ('pooled', verify_pooled),
+                         ('cached', verify_cached)]:
+        for concurrency in [1, 8]:
+            p50, p95 = run(verify, concurrency)
+            print('%-10s %12d %10.3f %10.3f' % (name, concurrency, p50, p95))
+
+    server.shutdown()
+
+
+def benchmark_list_encoding():
+    """Decode time and size of the pokemon list columns stored as pickled
+       lists and as packed integers
+    """
+
+    import pickle
+    import random
+    from column_types import pack_integer_list, unpack_integer_list
+
+    # Evolutions, types, weaknesses and moves of each generated pokemon
+    rows = []
+    for _ in range(1000):
+        rows.append([[random.randint(1, 806)],
+                     random.sample(range(1, 19), 2),
+                     random.sample(range(1, 19), 4),
+                     random.sample(range(1, 500), 15)])
+
+    pickled = [[pickle.dumps(values) for values in row] for row in rows]
+    packed = [[pack_integer_list(values) for values in row] for row in rows]
+
+    def decode(encoded_rows, decode_list):
+        for row in encoded_rows:
+            for value in row:
+                decode_list(value)
+
+    print('%-10s %12s %12s' % ('encoding', 'bytes', 'decode ms'))
+    for name, encoded_rows, decode_list in [
+            ('pickle', pickled, pickle.loads),
+            ('packed', packed, unpack_integer_list)]:
+        size = sum(len(value) for row in encoded_rows for value in row)
+        milliseconds = time_call(lambda: decode(encoded_rows, decode_list))
+        print('%-10s %12d %12.3f' % (name, size, milliseconds))
+    print('(1000 rows with 4 list columns each)')
+
+
+def benchmark_autocomplete():
+    """Lookup time of name suggestions by prefix with thousands of moves"""
+
+    # The indexes are filled from the database, which is not needed here
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    from autocomplete import PrefixIndex
+
+    print('%-8s %-10s %12s %12s' % ('names', 'prefix', 'matches', 'us'))
+    for count in [100, 5000, 50000]:
+        index = PrefixIndex('Move %05d' % number for number in range(count))
+        for prefix in ['m', 'move 0', 'move 000', 'x']:
+            matches = len(index.search(prefix))
+            milliseconds = time_call(lambda: index.search(prefix), 1000)
+            print('%-8d %-10s %12d %12.2f' % (count, prefix, matches,
+                                              milliseconds * 1000))
+
+
+def benchmark_similarity():
+    """Time to rank the pokemon most similar to one, comparing Python sets
+       and bitsets of their types, weaknesses and moves
+    """
+
+    import random
+    # The index is filled from the database, which is not needed here
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    from bitsets import SimilarityIndex, make_bitset, SIMILARITY_WEIGHTS
+
+    weights = [weight for _, weight in SIMILARITY_WEIGHTS]
+
+    def set_jaccard(id_set, other_id_set):
+        union = len(id_set | other_id_set)
+        return len(id_set & other_id_set) / union if union else 0.0
+
+    print('%-10s %12s %12s' % ('pokemon', 'sets ms', 'bitsets ms'))
+    for count in [800, 5000]:
+        id_lists = dict((id, [random.sample(range(1, 19), 2),
+                              random.sample(range(1, 19), 4),
+                              random.sample(range(1, 800), 15)])
+                        for id in range(1, count + 1))
+
+        id_sets = dict((id, [set(id_list) for id_list in lists])
+                       for id, lists in id_lists.items())
+
+        def rank_sets():
+            sets = id_sets[1]
+            return sorted((sum(weight * set_jaccard(a, b) for weight, a, b
+                               in zip(weights, sets, other_sets)), id)
+                          for id, other_sets in id_sets.items())[-10:]
+
+        index = SimilarityIndex()
+        index.loaded = index.checked = time.time()
+        index.pokemon = dict(
+            (id, ('', '', [make_bitset(id_list) for id_list in lists]))
+            for id, lists in id_lists.items())
+
+        def rank_bitsets():
+            index.results = {}
+            return index.get_similar(1, None)
+
+        print('%-10d %12.3f %12.3f' % (count, time_call(rank_sets),
+                                       time_call(rank_bitsets)))
+    print('(results are then cached until the catalog changes)')
+
+
+def benchmark_team():
+    """Time to score adding every candidate to a team of 5, comparing a
+       per-member loop and bit-sliced weakness counts, and to build a team
+       of 6
+    """
+
+    import random
+    # The optimizer is filled from the database, which is not needed here
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    from team_optimizer import (
+        TeamOptimizer, TeamBitsets, Candidate, make_bitset, MAX_TIME_BUDGET)
+
+    def score_loop(team, type_bitset, candidate):
+        shared = sum((member.weakness_bitset &
+                      candidate.weakness_bitset).bit_count()
+                     for member in team)
+        return ((candidate.type_bitset & ~type_bitset).bit_count() -
+                shared)
+
+    print('%-10s %12s %12s %12s' % ('pokemon', 'loop ms', 'sliced ms',
+                                    'team ms'))
+    for count in [800, 5000]:
+        pokemon = dict(
+            (id, (make_bitset(random.sample(range(1, 19), 2)),
+                  make_bitset(random.sample(range(1, 19), 4)), False, False))
+            for id in range(1, count + 1))
+        candidates = [Candidate(type_bitset, weakness_bitset)
+                      for type_bitset, weakness_bitset, _, _
+                      in pokemon.values()]
+        team = candidates[:5]
+        team_bitsets = TeamBitsets(team)
+
+        def score_all_loop():
+            return [score_loop(team, team_bitsets.type_bitset, candidate)
+                    for candidate in candidates]
+
+        def score_all_sliced():
+            return [team_bitsets.score_addition(candidate)
+                    for candidate in candidates]
+
+        optimizer = TeamOptimizer()
+        optimizer.loaded = time.time()
+        optimizer.pokemon = pokemon
+
+        def optimize():
+            return optimizer.optimize(None, time_budget=MAX_TIME_BUDGET)
+
+        print('%-10d %12.3f %12.3f %12.3f' % (
+            count, time_call(score_all_loop), time_call(score_all_sliced),
+            time_call(optimize, repeat=5)))
+
+
+def benchmark_sqlite_concurrency():
+    """Reads and writes per second of 8 reader and 8 writer threads on a
+       SQLite file, with the default rollback journal and with WAL, the
+       writer queue and a pool of read-only connections
+    """
+
+    import tempfile
+    import threading
+    from sqlalchemy import text
+    from sqlalchemy.exc import OperationalError
+    # Only the engine helpers are needed, not the app database
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    from database_setup import create_sqlite_engine
+    from write_queue import WriteQueue
+
+    seconds = 2.0
+    threads = 8
+
+    def run(name, write_engine, read_engine, write_queue):
+        with write_engine.begin() as connection:
+            connection.execute(text(
+                'CREATE TABLE item (id INTEGER PRIMARY KEY, '
+                'value INTEGER, payload TEXT)'))
+            connection.execute(text(
+                'INSERT INTO item (value, payload) VALUES (:value, :payload)'),
+                [{'value': 0, 'payload': 'x' * 200} for _ in range(2000)])
+
+        counts = {'reads': 0, 'writes': 0, 'errors': 0}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + seconds
+
+        def count(key):
+            with lock:
+                counts[key] += 1
+
+        def write(number):
+            # Read and then change a row, like the edit form
+            with write_engine.begin() as connection:
+                value = connection.execute(text(
+                    'SELECT value FROM item WHERE id = :id'),
+                    {'id': number % 2000 + 1}).scalar()
+                connection.execute(text(
+                    'UPDATE item SET value = :value WHERE id = :id'),
+                    {'value': value + 1, 'id': number % 2000 + 1})
+
+        def writer(thread_number):
+            number = thread_number
+            while time.perf_counter() < deadline:
+                try:
+                    write_queue.run(write, number)
+                    count('writes')
+                except OperationalError:
+                    count('errors')
+                number += threads
+
+        def reader():
+            while time.perf_counter() < deadline:
+                try:
+                    with read_engine.connect() as connection:
+                        connection.execute(text(
+                            'SELECT id, payload FROM item WHERE value >= 0 '
+                            'ORDER BY value DESC LIMIT 50')).fetchall()
+                    count('reads')
+                except OperationalError:
+                    count('errors')
+
+        workers = ([threading.Thread(target=writer, args=(number,))
+                    for number in range(threads)] +
+                   [threading.Thread(target=reader) for _ in range(threads)])
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        print('%-22s %10.0f %10.0f %8d' % (
+            name, counts['reads'] / seconds, counts['writes'] / seconds,
+            counts['errors']))
+
+    print('%-22s %10s %10s %8s' % ('mode', 'reads/s', 'writes/s', 'errors'))
+    for name in ['rollback journal', 'wal + writer queue']:
+        directory = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        if name == 'rollback journal':
+            # Like the former engine: pysqlite waits 5 seconds for locks
+            write_engine = create_sqlite_engine(url, pragmas=[])
+            run(name, write_engine, write_engine, WriteQueue(enabled=False))
+        else:
+            write_engine = create_sqlite_engine(url)
+            run(name, write_engine,
+                create_sqlite_engine(url, read_only=True), WriteQueue())
+
+        for filename in os.listdir(directory):
+            os.remove(os.path.join(directory, filename))
+        os.rmdir(directory)
+
+
+def benchmark_streaming():
+    """Time to the first byte, total time and peak memory of the home page of
+       5000 pokemon, rendered whole and streamed
+    """
+
+    import tracemalloc
+    from sqlalchemy.orm import sessionmaker
+    # The checks seed an in-memory database unless one is given
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    from query_checks import seed_catalog
+    from database_setup import engine
+
+    seed_session = sessionmaker(bind=engine)()
+    seed_catalog(seed_session, 5000)
+    seed_session.close()
+
+    import pokemon_types
+    from flask import render_template
+    client = pokemon_types.app.test_client()
+
+    def render_whole():
+        with pokemon_types.app.test_request_context('/pokemon/'):
+            session = pokemon_types.session
+            page = render_template(
+                'home.html',
+                pokemon_list=pokemon_types.query_pokemon_tiles({}).all(),
+                types=session.query(pokemon_types.Type).order_by(
+                    pokemon_types.Type.name).all(),
+                facets=pokemon_types.get_cached_facet_counts({}),
+                selected_type='All')
+            session.remove()
+        yield page.encode('utf-8')
+
+    def render_streamed():
+        response = client.get('/pokemon/', buffered=False)
+        try:
+            for chunk in response.response:
+                yield chunk
+        finally:
+            response.close()
+
+    def measure(chunks):
+        tracemalloc.start()
+        start = time.perf_counter()
+        chunks = iter(chunks)
+        first = next(chunks)
+        first_byte = (time.perf_counter() - start) * 1000
+        size = len(first) + sum(len(chunk) for chunk in chunks)
+        total = (time.perf_counter() - start) * 1000
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+        return first_byte, total, peak, size
+
+    print('%-10s %14s %10s %10s %10s' % ('page', 'first byte ms', 'total ms',
+                                        'peak MB', 'KB'))
+    for name, render in [('whole', render_whole),
+                         ('streamed', render_streamed)]:
+        # The first run fills the caches of the app
+        measure(render())
+        first_byte, total, peak, size = measure(render())
+        print('%-10s %14.1f %10.1f %10.1f %10d' % (name, first_byte, total,
+                                                  peak, size / 1024))
+
+
+def benchmark_rate_limit():
+    """Cost per request of the rate limiter, with buckets in memory and in a
+       shared SQLite file, alone and on a small JSON endpoint
+    """
+
+    import tempfile
+    # The checks seed an in-memory database unless one is given
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    from sqlalchemy.orm import sessionmaker
+    from query_checks import seed_catalog
+    from database_setup import engine
+    from rate_limit import MemoryBuckets, SQLiteBuckets
+
+    seed_session = sessionmaker(bind=engine)()
+    seed_catalog(seed_session, 100)
+    seed_session.close()
+
+    import pokemon_types
+    client = pokemon_types.app.test_client()
+    limiter = pokemon_types.rate_limiter
+    # Buckets never run out, so every request is served
+    limiter.rate = limiter.burst = 1e9
+
+    path = os.path.join(tempfile.mkdtemp(), 'rate_limit.db')
+    clients = ['address:10.0.%s.%s' % (number // 256, number % 256)
+               for number in range(1000)]
+
+    def check():
+        for name in clients:
+            limiter.check(name)
+
+    def get():
+        client.get('/pokemon/type/json')
+
+    print('%-10s %12s %14s' % ('buckets', 'check us', 'request us'))
+    for name, enabled, buckets in [('off', False, MemoryBuckets()),
+                                   ('memory', True, MemoryBuckets()),
+                                   ('sqlite', True, SQLiteBuckets(path))]:
+        limiter.enabled = enabled
+        limiter.buckets = buckets
+        get()
+        print('%-10s %12.2f %14.1f' % (
+            name, time_call(check, 5) * 1000 / len(clients),
+            time_call(get, 500) * 1000))
+
+
+BENCHMARKS = {
+    'compression': benchmark_compression,
+    'login': benchmark_login,
+    'list_encoding': benchmark_list_encoding,
+    'autocomplete': benchmark_autocomplete,
+    'similarity': benchmark_similarity,
+    'team': benchmark_team,
+    'sqlite_concurrency': benchmark_sqlite_concurrency,
+    'streaming': benchmark_streaming,
+    'rate_limit': benchmark_rate_limit
+    }
+
+
+#
+# MAIN FUNCTION
+#
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+
+    for name in names:
+        if name not in BENCHMARKS:
+            print('Unknown benchmark: %s' % name)
+            sys.exit(1)
+
+        print('== %s: %s' % (name, BENCHMARKS[name].__doc__))
+        BENCHMARKS[name]()
+        print('')
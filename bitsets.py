@@ -0,0 +1,167 @@
+# BITSETS.PY finds the pokemon most similar to a given one for the Pokemon
+# Types app. The types, weaknesses and moves of each pokemon are kept as
+# bitsets, Python integers with bit n set for ID n, so the overlap with every
+# other pokemon takes a few integer operations each.
+
+import time
+import heapq
+import threading
+from sqlalchemy import func
+from database_setup import Pokemon, ChangeLog
+
+
+# Weight of the overlap of each list in the similarity score
+SIMILARITY_WEIGHTS = [
+    ('type_list', 0.4),
+    ('weakness_list', 0.2),
+    ('move_list', 0.4)
+    ]
+
+# Most similar pokemon returned at a time
+MAX_SIMILAR = 10
+
+
+def make_bitset(id_list):
+    """Return the bitset of the IDs
+
+       Args: id_list (list): Ex. [1, 3]
+       Return value: (int): Ex. 0b1010
+    """
+
+    bitset = 0
+    for id in id_list or []:
+        bitset |= 1 << id
+
+    return bitset
+
+
+def jaccard(bitset, other_bitset):
+    """Return the size of the intersection over the size of the union of the
+       bitsets. 0 when both are empty.
+    """
+
+    union = (bitset | other_bitset).bit_count()
+    if not union:
+        return 0.0
+
+    return (bitset & other_bitset).bit_count() / union
+
+
+class SimilarityIndex():
+    """Bitsets of the lists of every pokemon, loaded with a single query.
+       They and the results for each pokemon are kept until the catalog
+       changes. Every max_age seconds, the latest change logged is looked up
+       to pick up changes made by other worker processes. The index is only
+       loaded again when there is one.
+
+       The first lookup of each pokemon scores it against every other
+       pokemon, a few integer operations each: about 2.5 ms per 1000 pokemon
+       (see python benchmark.py similarity).
+    """
+
+    def __init__(self, max_age=30):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Load the bitsets from the database again on the next lookup"""
+
+        with self.lock:
+            self.loaded = None
+            self.checked = 0
+            self.generation = None
+            self.pokemon = {}
+            self.results = {}
+
+    def get_generation(self, session):
+        """Return the cursor of the latest change to the catalog"""
+
+        return session.query(func.max(ChangeLog.seq)).scalar() or 0
+
+    def load(self, session):
+        """Load the bitsets, names and images of all pokemon"""
+
+        # Read first, so changes made while loading are loaded again later
+        generation = self.get_generation(session)
+
+        columns = [getattr(Pokemon, name) for name, _ in SIMILARITY_WEIGHTS]
+        rows = session.query(Pokemon.id, Pokemon.name, Pokemon.image,
+                             *columns)
+
+        # ID: (name, image, bitset of each list)
+        pokemon = {}
+        for id, name, image, *id_lists in rows:
+            pokemon[id] = (name, image,
+                           [make_bitset(id_list) for id_list in id_lists])
+
+        with self.lock:
+            self.pokemon = pokemon
+            self.results = {}
+            self.generation = generation
+            self.loaded = self.checked = time.time()
+
+    def check_loaded(self, session):
+        """Load the index on the first lookup and after the catalog changed"""
+
+        if self.loaded is None:
+            self.load(session)
+        elif time.time() - self.checked > self.max_age:
+            self.checked = time.time()
+            if self.get_generation(session) != self.generation:
+                self.load(session)
+
+    def get_scores(self, id, session):
+        """Return the similarity score of every other pokemon to the pokemon
+           with the ID. Scores are symmetric.
+
+           Return value: (dict): Score of each pokemon ID
+        """
+
+        self.check_loaded(session)
+
+        pokemon = self.pokemon
+        if id not in pokemon:
+            return {}
+
+        bitsets = pokemon[id][2]
+        weights = [weight for _, weight in SIMILARITY_WEIGHTS]
+
+        def score(other_id):
+            other_bitsets = pokemon[other_id][2]
+            return sum(weight * jaccard(bitset, other_bitset)
+                       for weight, bitset, other_bitset
+                       in zip(weights, bitsets, other_bitsets))
+
+        return dict((other_id, score(other_id)) for other_id in pokemon
+                    if other_id != id)
+
+    def get_similar(self, id, session, limit=MAX_SIMILAR):
+        """Return up to limit pokemon most similar to the pokemon with the ID,
+           most similar first
+
+           Return value: (list): Ex. [{'id': 2, 'name': 'Ivysaur',
+                         'image': '...', 'score': 0.82}]
+        """
+
+        self.check_loaded(session)
+
+        pokemon = self.pokemon
+        results = self.results
+        if id not in pokemon:
+            return []
+
+        similar = results.get(id)
+        if similar is None:
+            # Ties go to the lower ID so results are stable
+            scores = ((score, -other_id) for other_id, score
+                      in self.get_scores(id, session).items())
+            similar = [(round(score, 4), -negative_id) for score, negative_id
+                       in heapq.nlargest(MAX_SIMILAR, scores) if score > 0]
+            results[id] = similar
+
+        return [{'id': other_id,
+                 'name': pokemon[other_id][0],
+                 'image': pokemon[other_id][1],
+                 'score': score}
+                for score, other_id in similar[:limit]]
@@ -0,0 +1,344 @@
+# CATALOG_SNAPSHOT.PY keeps a binary snapshot of the JSON API responses for
+# the whole catalog, each type and each pokemon, in plain and gzip form. It is
+# written atomically after every change and memory-mapped read-only by every
+# worker process, so the workers share a single copy of it through the page
+# cache instead of each keeping its own.
+#
+# File layout, all integers little-endian:
+#   header:  magic (8 bytes), entry count (uint32), generation (uint64)
+#   entries: sorted by key, each with the key (64 bytes, zero-padded), offset
+#            and length of the body, offset and length of the gzip body
+#            (length 0 if not worth compressing) and the SHA-1 of the body
+#   bodies:  the response bodies the entries point to
+
+import os
+import mmap
+import json
+import string
+import hashlib
+import struct
+import tempfile
+import threading
+from functools import wraps
+from sqlalchemy import asc, func
+from flask import request, current_app
+from database_setup import Pokemon, PokemonDisplay, Type, ChangeLog
+from view_model import serialize_display
+from compression import compress, MINIMUM_SIZE
+
+
+SNAPSHOT_PATH = os.environ.get('CATALOG_SNAPSHOT', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'catalog.snapshot'))
+
+MAGIC = b'PKSNAP01'
+HEADER = struct.Struct('<8sIQ')
+ENTRY = struct.Struct('<64sIIII20s')
+
+# Bodies are handed to the server in chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+ALL_KEY = 'all'
+
+
+#
+# SNAPSHOT KEYS
+#
+def get_all_key():
+    """Key of the body of /pokemon/json"""
+
+    return ALL_KEY
+
+
+def get_type_key(type):
+    """Key of the body of /pokemon/<type>/json"""
+
+    if type.lower() == 'all':
+        return ALL_KEY
+
+    return 'type:%s' % string.capwords(type)
+
+
+def get_pokemon_key(id):
+    """Key of the body of /pokemon/<id>/json"""
+
+    return 'pokemon:%s' % id
+
+
+#
+# WRITING SNAPSHOTS
+#
+def dump_json(data):
+    """Encode the data the way jsonify does outside of debug mode"""
+
+    return (json.dumps(data, sort_keys=True, separators=(',', ':')) +
+            '\n').encode('utf-8')
+
+
+def join_pokemon_json(pokemon_json_list):
+    """Build a {"Pokemon": [...]} body from already encoded pokemon"""
+
+    return b'{"Pokemon":[' + b','.join(pokemon_json_list) + b']}\n'
+
+
+def build_snapshot_bodies(session):
+    """Return the response body of every snapshot key
+
+       Return value: (dict): Ex. {'all': b'{"Pokemon":[...]}\n', ...}
+    """
+
+    type_lists = dict(session.query(Pokemon.id, Pokemon.type_list))
+
+    # Same order as the unfiltered JSON API endpoints
+    displays = session.query(PokemonDisplay).join(
+        Pokemon, Pokemon.id == PokemonDisplay.id).order_by(
+            asc(Pokemon.pokedex_id), asc(Pokemon.id))
+
+    bodies = {}
+    all_pokemon = []
+    pokemon_by_type = {}
+    for display in displays:
+        type_list = type_lists.get(display.id) or []
+        pokemon_json = dump_json(serialize_display(display))[:-1]
+        bodies[get_pokemon_key(display.id)] = join_pokemon_json(
+            [pokemon_json])
+        all_pokemon.append(pokemon_json)
+        for type_id in set(type_list):
+            pokemon_by_type.setdefault(type_id, []).append(pokemon_json)
+
+    bodies[ALL_KEY] = join_pokemon_json(all_pokemon)
+    for type in session.query(Type):
+        bodies[get_type_key(type.name)] = join_pokemon_json(
+            pokemon_by_type.get(type.id, []))
+
+    return bodies
+
+
+def get_catalog_generation(session):
+    """Return the cursor of the latest change to the catalog"""
+
+    return session.query(func.max(ChangeLog.seq)).scalar() or 0
+
+
+def read_generation(path):
+    """Return the generation of the snapshot file or None if there is no
+       valid snapshot
+    """
+
+    try:
+        with open(path, 'rb') as snapshot_file:
+            magic, _, generation = HEADER.unpack(
+                snapshot_file.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+
+    if magic != MAGIC:
+        return None
+
+    return generation
+
+
+# Threads of a process write the snapshot one at a time, so an older
+# generation never replaces a newer one
+snapshot_lock = threading.Lock()
+
+
+def write_catalog_snapshot(session, path=SNAPSHOT_PATH, force=False):
+    """Write the snapshot of the catalog unless the file already has the
+       latest changes. The file is replaced atomically, so readers see either
+       the old or the new snapshot.
+
+       Return value: (bool): Whether a snapshot was written
+    """
+
+    with snapshot_lock:
+        generation = get_catalog_generation(session)
+        current = read_generation(path)
+        if current is not None and not force and current >= generation:
+            return False
+
+        write_snapshot_file(path, generation, build_snapshot_bodies(session))
+
+    return True
+
+
+def write_snapshot_file(path, generation, bodies):
+    """Write the snapshot file of the response bodies through a temporary
+       file of its own, then move it over the previous snapshot
+    """
+
+    entries = []
+    chunks = []
+    offset = HEADER.size
+    keys = sorted((key.encode('utf-8'), key) for key in bodies)
+    keys = [item for item in keys if len(item[0]) <= 64]
+    offset += ENTRY.size * len(keys)
+
+    for encoded_key, key in keys:
+        data = bodies[key]
+        gzip_data = b''
+        if len(data) >= MINIMUM_SIZE:
+            compressed = compress(data, 'gzip')
+            if len(compressed) < len(data) * 0.9:
+                gzip_data = compressed
+
+        entries.append(ENTRY.pack(
+            encoded_key, offset, len(data), offset + len(data),
+            len(gzip_data), hashlib.sha1(data).digest()))
+        chunks.append(data)
+        chunks.append(gzip_data)
+        offset += len(data) + len(gzip_data)
+
+    descriptor, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=os.path.basename(path) + '.',
+        suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as snapshot_file:
+            snapshot_file.write(HEADER.pack(MAGIC, len(entries), generation))
+            snapshot_file.writelines(entries)
+            snapshot_file.writelines(chunks)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        # mkstemp only lets the owner read the file
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+#
+# READING SNAPSHOTS
+#
+class SnapshotBody():
+    """A response body inside a mapped snapshot. Holding it keeps the
+       mapping open while the response is sent.
+    """
+
+    def __init__(self, mapping, offset, length, gzip_offset, gzip_length,
+                 digest):
+        self.mapping = mapping
+        self.offset = offset
+        self.length = length
+        self.gzip_offset = gzip_offset
+        self.gzip_length = gzip_length
+        self.etag = digest.hex()
+
+    def iter_chunks(self, offset, length):
+        """Yield the bytes of the mapping in chunks. WSGI servers only send
+           bytes, so only one chunk at a time is copied out of the mapping.
+        """
+
+        end = offset + length
+        while offset < end:
+            yield self.mapping[offset:min(offset + CHUNK_SIZE, end)]
+            offset += CHUNK_SIZE
+
+    def make_response(self, response_class):
+        """Build the response for the current request, gzipped if the client
+           accepts it
+        """
+
+        offset, length = self.offset, self.length
+        encoding = None
+        if self.gzip_length:
+            encoding = request.accept_encodings.best_match(['gzip'])
+            if encoding:
+                offset, length = self.gzip_offset, self.gzip_length
+
+        response = response_class(self.iter_chunks(offset, length),
+                                  mimetype='application/json',
+                                  direct_passthrough=True)
+        response.content_length = length
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if self.gzip_length:
+            response.vary.add('Accept-Encoding')
+
+        response.set_etag(self.etag)
+        return response.make_conditional(request)
+
+
+class CatalogSnapshot():
+    """Read-only view of the snapshot file. The file is mapped again when
+       another process replaces it, which is checked on every lookup.
+    """
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        # (file identity, mapping, entry count) of the mapped file
+        self.current = (None, None, 0)
+
+    def refresh(self):
+        """Map the snapshot file if it changed since last mapped"""
+
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.current = (None, None, 0)
+            return
+
+        if (stat.st_ino, stat.st_mtime_ns) == self.current[0]:
+            return
+
+        try:
+            with open(self.path, 'rb') as snapshot_file:
+                stat = os.fstat(snapshot_file.fileno())
+                mapping = mmap.mmap(snapshot_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.current = (None, None, 0)
+            return
+
+        magic, count, _ = HEADER.unpack_from(mapping, 0)
+        if magic != MAGIC:
+            self.current = (None, None, 0)
+            return
+
+        # A mapping replaced here is closed once no response uses it
+        self.current = ((stat.st_ino, stat.st_mtime_ns), mapping, count)
+
+    def get(self, key):
+        """Return the SnapshotBody of the key or None if not in the snapshot"""
+
+        self.refresh()
+        _, mapping, count = self.current
+        if mapping is None:
+            return None
+
+        # Binary search of the sorted entries
+        encoded_key = key.encode('utf-8').ljust(64, b'\0')
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            position = HEADER.size + middle * ENTRY.size
+            entry_key = mapping[position:position + 64]
+            if entry_key < encoded_key:
+                low = middle + 1
+            elif entry_key > encoded_key:
+                high = middle
+            else:
+                return SnapshotBody(mapping, *ENTRY.unpack_from(
+                    mapping, position)[1:])
+
+        return None
+
+
+def served_from_snapshot(snapshot, make_key):
+    """Decorator for JSON views answered from the snapshot when the request
+       has no parameters. Other requests and keys missing from the snapshot
+       go to the view.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def snapshot_view(*args, **kwargs):
+            if not request.args:
+                body = snapshot.get(make_key(*args, **kwargs))
+                if body is not None:
+                    return body.make_response(current_app.response_class)
+
+            return view(*args, **kwargs)
+
+        return snapshot_view
+
+    return decorator
@@ -0,0 +1,195 @@
+# CHANGE_LOG.PY keeps the change feed of the Pokemon Types app. Each flush of
+# a session logs the pokemon, moves and categories it added, changed or
+# deleted, so mirrors of the JSON API can fetch only what changed since their
+# last sync.
+
+from sqlalchemy import event, insert, delete, select, func
+from sqlalchemy.orm import Session
+from database_setup import (
+    ChangeLog,
+    Pokemon,
+    PokemonDisplay,
+    Move,
+    Category,
+    utc_now
+    )
+from view_model import serialize_display
+
+
+# Kind of change logged for the rows of each table. A changed display row
+# means the pokemon shown by the JSON API changed, ex. when the pokemon it
+# evolves to was renamed.
+CHANGE_KINDS = {
+    Pokemon: 'pokemon',
+    PokemonDisplay: 'pokemon',
+    Move: 'move',
+    Category: 'category'
+    }
+
+# Most changes returned at a time
+CHANGES_PAGE_SIZE = 500
+
+# Most rows logged per statement
+LOG_BATCH_SIZE = 500
+
+# Key in session.info of the rows logged in the current transaction
+PENDING_CHANGES = 'pending_changes'
+
+# Key of the PostgreSQL advisory lock taken by transactions logging changes
+CHANGE_LOG_LOCK = 0x636c6f67
+
+
+#
+# LOGGING FUNCTIONS
+#
+def log_changes(session, kind, row_ids, is_deleted=False):
+    """Log the rows as changed or deleted in the current transaction. An
+       earlier change of the same row is replaced. Statements go straight to
+       the connection so this may run during a flush. The rows are given to
+       the callbacks of watch_changes once the transaction is committed.
+       On PostgreSQL, transactions logging changes hold a lock until they
+       end, so seq values are committed in order and a mirror never reads a
+       seq before a smaller one is committed. SQLite already runs one
+       writing transaction at a time.
+
+       Args: kind (str): 'pokemon', 'move' or 'category'
+             row_ids (list): IDs of the rows
+             is_deleted (bool): Whether the rows were deleted
+    """
+
+    row_ids = sorted(set(row_ids))
+    session.info.setdefault(PENDING_CHANGES, set()).update(
+        (kind, row_id) for row_id in row_ids)
+    connection = session.connection()
+    if connection.dialect.name == 'postgresql':
+        connection.execute(select(func.pg_advisory_xact_lock(
+            CHANGE_LOG_LOCK)))
+    changed_at = utc_now()
+
+    for start in range(0, len(row_ids), LOG_BATCH_SIZE):
+        batch = row_ids[start:start + LOG_BATCH_SIZE]
+        connection.execute(delete(ChangeLog.__table__).where(
+            ChangeLog.kind == kind, ChangeLog.row_id.in_(batch)))
+        connection.execute(insert(ChangeLog.__table__), [
+            {'kind': kind, 'row_id': row_id, 'is_deleted': is_deleted,
+             'changed_at': changed_at} for row_id in batch])
+
+
+@event.listens_for(Session, 'after_flush')
+def log_flushed_changes(session, flush_context):
+    """Log the rows of the catalog added, changed or deleted by the flush"""
+
+    changed = {}
+    deleted = {}
+
+    for instance in session.new:
+        kind = CHANGE_KINDS.get(type(instance))
+        if kind:
+            changed.setdefault(kind, set()).add(instance.id)
+
+    for instance in session.dirty:
+        kind = CHANGE_KINDS.get(type(instance))
+        if kind and session.is_modified(instance):
+            changed.setdefault(kind, set()).add(instance.id)
+
+    for instance in session.deleted:
+        kind = CHANGE_KINDS.get(type(instance))
+        if type(instance) is PokemonDisplay:
+            # Deleting a display row alone does not delete the pokemon
+            changed.setdefault(kind, set()).add(instance.id)
+        elif kind:
+            deleted.setdefault(kind, set()).add(instance.id)
+
+    for kind, row_ids in changed.items():
+        row_ids = row_ids.difference(deleted.get(kind, ()))
+        if row_ids:
+            log_changes(session, kind, row_ids)
+
+    for kind, row_ids in deleted.items():
+        log_changes(session, kind, row_ids, is_deleted=True)
+
+
+def watch_changes(callback):
+    """Call the callback after each commit with the rows the transaction
+       changed or deleted, ex. to drop them from a cache
+
+       Args: callback (function): Given a set of (kind, row ID)
+    """
+
+    @event.listens_for(Session, 'after_commit')
+    def changes_committed(session):
+        changes = session.info.pop(PENDING_CHANGES, None)
+        if changes:
+            callback(changes)
+
+    @event.listens_for(Session, 'after_rollback')
+    def changes_rolled_back(session):
+        session.info.pop(PENDING_CHANGES, None)
+
+
+def start_change_log(session):
+    """Log every row of the catalog when the change log is empty, ex. for a
+       database created before the change feed. The caller commits.
+    """
+
+    if session.query(ChangeLog.seq).first() is not None:
+        return
+
+    for model, kind in [(Category, 'category'), (Move, 'move'),
+                        (Pokemon, 'pokemon')]:
+        row_ids = [id for id, in session.query(model.id)]
+        if row_ids:
+            log_changes(session, kind, row_ids)
+
+
+#
+# CHANGE FEED
+#
+def get_changes(session, since=0, limit=CHANGES_PAGE_SIZE):
+    """Return the changes logged after the cursor, oldest first, with the
+       current details of the rows not deleted
+
+       Args: since (int): Cursor returned by an earlier call. 0 for all.
+             limit (int): Most changes to return
+       Return value: (dict): Ex. {'Changes': [...], 'cursor': 12,
+                     'has_more': False}
+    """
+
+    entries = session.query(ChangeLog).filter(
+        ChangeLog.seq > since).order_by(ChangeLog.seq).limit(limit + 1).all()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    # Look up the details of each kind with a single query
+    ids_by_kind = {}
+    for entry in entries:
+        if not entry.is_deleted:
+            ids_by_kind.setdefault(entry.kind, []).append(entry.row_id)
+
+    details = {}
+    if ids_by_kind.get('pokemon'):
+        for display in session.query(PokemonDisplay).filter(
+                PokemonDisplay.id.in_(ids_by_kind['pokemon'])):
+            details[('pokemon', display.id)] = serialize_display(display)
+    for model, kind in [(Move, 'move'), (Category, 'category')]:
+        if ids_by_kind.get(kind):
+            for row in session.query(model).filter(
+                    model.id.in_(ids_by_kind[kind])):
+                details[(kind, row.id)] = row.serialize
+
+    changes = []
+    for entry in entries:
+        changes.append({
+            'cursor': entry.seq,
+            'kind': entry.kind,
+            'id': entry.row_id,
+            'deleted': entry.is_deleted,
+            'changed_at': entry.changed_at.isoformat() + 'Z',
+            'data': details.get((entry.kind, entry.row_id))
+            })
+
+    return {
+        'Changes': changes,
+        'cursor': entries[-1].seq if entries else since,
+        'has_more': has_more
+        }
@@ -0,0 +1,449 @@
+# CHECK_CATALOG.PY checks the catalog of the Pokemon Types app for problems
+# that build up silently: references to types, moves, categories, users or
+# evolutions that no longer exist, values stored with the wrong type, list
+# columns that cannot be decoded, duplicate Pokedex IDs and missing or
+# orphaned display rows. The pokemon table is scanned in ranges of IDs on a
+# pool of worker processes, so no process loads the whole catalog. With
+# --repair, the problems that can be fixed safely are fixed in batches, each
+# in its own transaction, and logged to the change feed.
+#
+# Usage: python check_catalog.py [--repair] [--evolutions]
+# --evolutions also drops, when repairing, evolutions referring to Pokedex IDs
+# no pokemon has. These are kept by default since pages show them as
+# "Pokemon with Pokedex ID# ..." until that pokemon is added.
+# Exits with status 1 when problems are left.
+
+import os
+import sys
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import text, exists
+from sqlalchemy.orm import sessionmaker
+from database_setup import (
+    engine,
+    Pokemon,
+    PokemonDisplay,
+    User,
+    Category,
+    Type,
+    Move
+    )
+from column_types import unpack_integer_list
+from migrate_list_columns import is_pickled
+
+
+# Worker processes scanning the pokemon table, one per CPU by default
+CHECK_WORKERS = int(os.environ.get('CHECK_WORKERS', 0)) or \
+    os.cpu_count() or 1
+
+# Pokemon IDs scanned by each task given to a worker
+CHUNK_SIZE = 5000
+
+# Most pokemon repaired per transaction
+REPAIR_BATCH_SIZE = 500
+
+# Problems listed for each kind, the others are only counted
+MAX_EXAMPLES = 10
+
+# List columns of the pokemon table and the table their IDs refer to
+LIST_REFERENCES = [
+    ('type_list', 'type'),
+    ('weakness_list', 'type'),
+    ('move_list', 'move')
+    ]
+
+# Columns of the pokemon table checked, read without their column types
+ROW_QUERY = ('SELECT id, pokedex_id, evolution_before, evolution_after_list, '
+             'type_list, weakness_list, move_list, category_id, user_id '
+             'FROM pokemon ')
+
+# IDs of the rows each worker checks references against
+references = None
+
+
+#
+# REFERENCES
+#
+def load_references(connection):
+    """Load the IDs of the rows pokemon refer to. Only single columns are
+       read, so this stays small next to the pokemon table.
+
+       Return value: (dict): Set of IDs per table, and of the Pokedex IDs
+                     under 'pokedex'
+    """
+
+    loaded = {}
+    for name, table in [('type', Type), ('move', Move),
+                        ('category', Category), ('user', User)]:
+        loaded[name] = set(id for id, in connection.execute(text(
+            'SELECT id FROM %s' % table.__tablename__)))
+
+    loaded['pokedex'] = set()
+    for pokedex_id, in connection.execute(text(
+            'SELECT DISTINCT pokedex_id FROM pokemon')):
+        number = to_integer(pokedex_id)
+        if number is not None:
+            loaded['pokedex'].add(number)
+
+    return loaded
+
+
+def to_integer(value):
+    """Return the value as an integer or None if it is not a whole number.
+       SQLite keeps whatever type a value was written with.
+    """
+
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().lstrip('-').isdigit():
+        return int(value)
+
+    return None
+
+
+def decode_list(value):
+    """Decode a list column as read without its column type
+
+       Return value: (list): The IDs, or None if the value cannot be decoded
+    """
+
+    if value is None:
+        return []
+    if isinstance(value, list):
+        # PostgreSQL arrays
+        return value
+    if isinstance(value, memoryview):
+        value = bytes(value)
+    if not isinstance(value, bytes) or len(value) % 4:
+        return None
+    # Only values framed like a pickle are unpickled, since unpickling
+    # packed integers may fail in odd ways
+    if value.startswith(b'\x80') and value.endswith(b'.') and \
+            is_pickled(value):
+        return None
+
+    return unpack_integer_list(value)
+
+
+#
+# CHECKS
+#
+def init_worker():
+    """Give the worker process its own connections and load the references"""
+
+    global references
+
+    # Connections opened by the parent process must not be shared
+    engine.dispose(close=False)
+
+    with engine.connect() as connection:
+        references = load_references(connection)
+
+
+def check_row(row, drop_evolutions):
+    """Check the references and value types of a pokemon row
+
+       Args: row (Row): Columns of the pokemon table, read without their
+                 column types
+       Return value: (tuple): List of problems (kind, pokemon ID, detail) and
+                     dict of the repaired values of the columns to change,
+                     or None if the row cannot be repaired
+    """
+
+    problems = []
+    fixes = {}
+
+    def report(kind, detail):
+        problems.append((kind, row.id, detail))
+
+    pokedex_id = to_integer(row.pokedex_id)
+    if pokedex_id is None:
+        report('wrong type', 'pokedex_id is %r' % (row.pokedex_id,))
+    elif not isinstance(row.pokedex_id, int):
+        report('wrong type', 'pokedex_id is %r' % (row.pokedex_id,))
+        fixes['pokedex_id'] = pokedex_id
+
+    evolution_before = row.evolution_before
+    if evolution_before is not None:
+        number = to_integer(evolution_before)
+        if number is None:
+            report('wrong type', 'evolution_before is %r' % evolution_before)
+            fixes['evolution_before'] = None
+        else:
+            if not isinstance(evolution_before, int):
+                report('wrong type',
+                       'evolution_before is %r' % evolution_before)
+                fixes['evolution_before'] = number
+            if number not in references['pokedex']:
+                report('unknown evolution',
+                       'evolves from Pokedex ID %s' % number)
+                if drop_evolutions:
+                    fixes['evolution_before'] = None
+
+    evolution_after_list = decode_list(row.evolution_after_list)
+    if evolution_after_list is None:
+        report('undecodable list', 'evolution_after_list')
+    else:
+        unknown = [number for number in evolution_after_list
+                   if number not in references['pokedex']]
+        if unknown:
+            report('unknown evolution', 'evolves to Pokedex IDs %s' % unknown)
+            if drop_evolutions:
+                fixes['evolution_after_list'] = [
+                    number for number in evolution_after_list
+                    if number not in unknown]
+
+    for column, table in LIST_REFERENCES:
+        id_list = decode_list(getattr(row, column))
+        if id_list is None:
+            report('undecodable list', column)
+            continue
+
+        missing = [id for id in id_list if id not in references[table]]
+        if missing:
+            report('missing %s' % table, '%s has IDs %s' % (column, missing))
+            kept = [id for id in id_list if id not in missing]
+            if column == 'type_list' and not kept:
+                # Left to be fixed by hand, since every pokemon has a type
+                report('no type left', 'all types are missing')
+            else:
+                fixes[column] = kept
+
+    if row.category_id not in references['category']:
+        report('missing category', 'category_id is %r' % (row.category_id,))
+    if row.user_id is not None and row.user_id not in references['user']:
+        report('missing user', 'user_id is %r' % (row.user_id,))
+
+    if any(kind == 'undecodable list' for kind, _, _ in problems):
+        # The app cannot load the row, so it is left to
+        # migrate_list_columns.py or to be fixed by hand
+        fixes = None
+
+    return problems, fixes
+
+
+def check_chunk(start, end, drop_evolutions):
+    """Check the pokemon with IDs from start up to end
+
+       Return value: (tuple): List of problems and dict of the repairs of
+                     each pokemon ID, None for the pokemon that cannot be
+                     repaired
+    """
+
+    problems = []
+    repairs = {}
+    with engine.connect() as connection:
+        rows = connection.execute(text(
+            ROW_QUERY + 'WHERE id >= :start AND id < :end'),
+            {'start': start, 'end': end})
+
+        for row in rows:
+            row_problems, fixes = check_row(row, drop_evolutions)
+            problems.extend(row_problems)
+            if fixes or fixes is None:
+                repairs[row.id] = fixes
+
+    return problems, repairs
+
+
+def check_tables(connection):
+    """Checks answered by the database as a whole
+
+       Return value: (tuple): List of problems, and lists of the IDs of the
+                     pokemon without display rows and of the orphaned display
+                     rows
+    """
+
+    problems = []
+    for pokedex_id, count in connection.execute(text(
+            'SELECT pokedex_id, COUNT(*) FROM pokemon GROUP BY pokedex_id '
+            'HAVING COUNT(*) > 1 ORDER BY pokedex_id')):
+        problems.append(('duplicate pokedex_id', None,
+                         'Pokedex ID %s is used by %s pokemon'
+                         % (pokedex_id, count)))
+
+    missing_displays = [id for id, in connection.execute(text(
+        'SELECT pokemon.id FROM pokemon LEFT JOIN pokemon_display '
+        'ON pokemon_display.id = pokemon.id '
+        'WHERE pokemon_display.id IS NULL ORDER BY pokemon.id'))]
+    for id in missing_displays:
+        problems.append(('missing display row', id, ''))
+
+    orphaned_displays = [id for id, in connection.execute(text(
+        'SELECT pokemon_display.id FROM pokemon_display LEFT JOIN pokemon '
+        'ON pokemon.id = pokemon_display.id '
+        'WHERE pokemon.id IS NULL ORDER BY pokemon_display.id'))]
+    for id in orphaned_displays:
+        problems.append(('orphaned display row', id, ''))
+
+    return problems, missing_displays, orphaned_displays
+
+
+def check_catalog(drop_evolutions=False, workers=CHECK_WORKERS):
+    """Check the whole catalog
+
+       Return value: (tuple): List of problems, dict of the repairs of each
+                     pokemon ID, and lists of the IDs of the pokemon without
+                     display rows and of the orphaned display rows
+    """
+
+    with engine.connect() as connection:
+        problems, missing_displays, orphaned_displays = check_tables(
+            connection)
+        low, high = connection.execute(text(
+            'SELECT MIN(id), MAX(id) FROM pokemon')).one()
+
+    chunks = []
+    if low is not None:
+        chunks = [(start, start + CHUNK_SIZE)
+                  for start in range(low, high + 1, CHUNK_SIZE)]
+
+    # Worker processes open their own connections
+    engine.dispose()
+
+    if workers <= 1 or len(chunks) <= 1:
+        init_worker()
+        results = [check_chunk(start, end, drop_evolutions)
+                   for start, end in chunks]
+    else:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        with ProcessPoolExecutor(min(workers, len(chunks)),
+                                 mp_context=context,
+                                 initializer=init_worker) as executor:
+            futures = [executor.submit(check_chunk, start, end,
+                                       drop_evolutions)
+                       for start, end in chunks]
+            results = [future.result() for future in futures]
+
+    repairs = {}
+    for chunk_problems, chunk_repairs in results:
+        problems.extend(chunk_problems)
+        repairs.update(chunk_repairs)
+
+    return problems, repairs, missing_displays, orphaned_displays
+
+
+#
+# REPAIRS
+#
+def repair_catalog(repairs, missing_displays, orphaned_displays,
+                   drop_evolutions=False):
+    """Repair the pokemon and write the missing display rows, in batches.
+       Each batch checks its rows again in its own transaction and only
+       applies the fixes found then, so edits made since the scan are kept.
+       Changes are logged to the change feed, so mirrors and the caches of
+       the web server pick them up.
+
+       Return value: (int): Number of pokemon and display rows repaired
+    """
+
+    global references
+
+    # Imported here, since checking alone needs none of the app
+    from sqlalchemy import bindparam
+    from view_model import refresh_pokemon_displays
+    from change_log import log_changes
+    from catalog_snapshot import write_catalog_snapshot
+
+    session = sessionmaker(bind=engine)()
+    row_sql = ROW_QUERY + 'WHERE id IN :ids'
+    if engine.dialect.name == 'postgresql':
+        # App edits of the rows wait until the batch is committed
+        row_sql += ' FOR UPDATE'
+    row_query = text(row_sql).bindparams(bindparam('ids', expanding=True))
+
+    missing_displays = set(missing_displays)
+    repaired = 0
+    try:
+        ids = sorted(id for id in set(repairs).union(missing_displays)
+                     if repairs.get(id, {}) is not None)
+        for start in range(0, len(ids), REPAIR_BATCH_SIZE):
+            batch = ids[start:start + REPAIR_BATCH_SIZE]
+            connection = session.connection()
+            references = load_references(connection)
+
+            batch_fixes = {}
+            for row in connection.execute(row_query, {'ids': batch}):
+                fixes = check_row(row, drop_evolutions)[1]
+                if fixes is not None:
+                    batch_fixes[row.id] = fixes
+
+            pokemon_list = session.query(Pokemon).filter(
+                Pokemon.id.in_(list(batch_fixes))).all()
+            pokemon_list = [pokemon for pokemon in pokemon_list
+                            if batch_fixes[pokemon.id] or
+                            pokemon.id in missing_displays]
+            for pokemon in pokemon_list:
+                for column, value in batch_fixes[pokemon.id].items():
+                    setattr(pokemon, column, value)
+            session.flush()
+            refresh_pokemon_displays(pokemon_list, session)
+            session.commit()
+            repaired += len(pokemon_list)
+
+        for start in range(0, len(orphaned_displays), REPAIR_BATCH_SIZE):
+            batch = orphaned_displays[start:start + REPAIR_BATCH_SIZE]
+            repaired += session.query(PokemonDisplay).filter(
+                PokemonDisplay.id.in_(batch),
+                ~exists().where(Pokemon.id == PokemonDisplay.id)).delete(
+                    synchronize_session=False)
+            # Mirrors still showing these pokemon drop them
+            log_changes(session, 'pokemon', batch, is_deleted=True)
+            session.commit()
+
+        write_catalog_snapshot(session)
+    finally:
+        session.close()
+
+    return repaired
+
+
+def print_problems(problems):
+    """Print the number of problems of each kind with a few examples"""
+
+    by_kind = {}
+    for kind, id, detail in problems:
+        by_kind.setdefault(kind, []).append((id, detail))
+
+    for kind in sorted(by_kind):
+        print('%-22s %8d' % (kind, len(by_kind[kind])))
+        for id, detail in by_kind[kind][:MAX_EXAMPLES]:
+            if id is None:
+                print('    %s' % detail)
+            else:
+                print(('    pokemon %s %s' % (id, detail)).rstrip())
+        if len(by_kind[kind]) > MAX_EXAMPLES:
+            print('    ...')
+
+
+#
+# MAIN FUNCTION
+#
+if __name__ == '__main__':
+    repair = '--repair' in sys.argv
+    drop_evolutions = '--evolutions' in sys.argv
+
+    start = time.perf_counter()
+    problems, repairs, missing_displays, orphaned_displays = check_catalog(
+        drop_evolutions)
+    print_problems(problems)
+    print('%s problems found in %.1f s' % (len(problems),
+                                           time.perf_counter() - start))
+
+    if repair and (repairs or missing_displays or orphaned_displays):
+        start = time.perf_counter()
+        count = repair_catalog(repairs, missing_displays, orphaned_displays,
+                               drop_evolutions)
+        print('Repaired %s rows in %.1f s' % (
+            count, time.perf_counter() - start))
+
+        problems = check_catalog(drop_evolutions)[0]
+        print('%s problems left' % len(problems))
+
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,135 @@
+# COLUMN_TYPES.PY defines custom column types used by the tables of the
+# Pokemon Types app
+
+import struct
+import sqlite3
+from sqlalchemy import Integer, LargeBinary, Boolean, event, literal
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.types import TypeDecorator
+
+
+#
+# INTEGER LIST ENCODING
+#
+
+# Compiled formats for unpacking, by number of integers
+INTEGER_LIST_FORMATS = {}
+
+
+def get_integer_list_format(count):
+    """Return the compiled format for count 32-bit little-endian integers"""
+
+    integer_list_format = INTEGER_LIST_FORMATS.get(count)
+    if integer_list_format is None:
+        integer_list_format = struct.Struct('<%di' % count)
+        INTEGER_LIST_FORMATS[count] = integer_list_format
+
+    return integer_list_format
+
+
+def pack_integer_list(values):
+    """Pack the integers as 32-bit little-endian values
+
+       Args: values (list): Ex. [12, 3]
+       Return value: (bytes): 4 bytes per value
+    """
+
+    values = [int(value) for value in values]
+    return get_integer_list_format(len(values)).pack(*values)
+
+
+def unpack_integer_list(data):
+    """Unpack integers packed by pack_integer_list"""
+
+    return list(get_integer_list_format(len(data) // 4).unpack(data))
+
+
+class IntegerList(TypeDecorator):
+    """List of integers stored as a native INTEGER[] on PostgreSQL and as a
+       blob of packed integers on other databases. Unlike PickleType, values
+       are cheap to decode and PostgreSQL can query them.
+    """
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.ARRAY(Integer))
+
+        return dialect.type_descriptor(LargeBinary())
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+
+        if dialect.name == 'postgresql':
+            return [int(item) for item in value]
+
+        return pack_integer_list(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+
+        if dialect.name == 'postgresql':
+            return list(value)
+
+        return unpack_integer_list(value)
+
+
+#
+# INTEGER LIST QUERIES
+#
+class integer_list_contains(FunctionElement):
+    """SQL condition that an IntegerList column contains the value. Compiles
+       to the array operator @> on PostgreSQL, which a GIN index can serve,
+       and to a registered function on SQLite.
+
+       Ex. query.filter(integer_list_contains(Pokemon.type_list, type_id))
+       The value may also be a column, ex. Move.id in a correlated subquery.
+    """
+
+    name = 'integer_list_contains'
+    type = Boolean()
+    inherit_cache = True
+
+    def __init__(self, column, value):
+        if isinstance(value, (int, str)):
+            value = literal(int(value), Integer)
+        super().__init__(column, value)
+
+
+@compiles(integer_list_contains)
+def compile_integer_list_contains(element, compiler, **kw):
+    return 'integer_list_contains(%s)' % compiler.process(element.clauses,
+                                                          **kw)
+
+
+@compiles(integer_list_contains, 'postgresql')
+def compile_integer_list_contains_postgresql(element, compiler, **kw):
+    column, value = list(element.clauses)
+    return '(%s @> ARRAY[%s])' % (compiler.process(column, **kw),
+                                  compiler.process(value, **kw))
+
+
+def sqlite_integer_list_contains(data, value):
+    """SQLite implementation of integer_list_contains"""
+
+    if data is None:
+        return 0
+
+    return int(value in unpack_integer_list(data))
+
+
+@event.listens_for(Engine, 'connect')
+def register_sqlite_functions(dbapi_connection, connection_record):
+    """Make the integer list functions available to SQLite connections"""
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function(
+            'integer_list_contains', 2, sqlite_integer_list_contains,
+            deterministic=True)
@@ -0,0 +1,291 @@
+# COMPRESSION.PY negotiates gzip and brotli compression of the responses of the
+# Pokemon Types app. Static files and cached JSON snapshots are compressed once
+# and served from memory.
+
+import os
+import gzip
+import zlib
+import hashlib
+import mimetypes
+import time
+from functools import wraps
+from flask import request, current_app
+
+# Brotli is optional. Only gzip is offered when it is not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Responses smaller than this (in bytes) are sent uncompressed since the
+# savings do not make up for the work and the extra headers
+MINIMUM_SIZE = 512
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+COMPRESSIBLE_MIMETYPES = [
+    'application/json',
+    'application/javascript',
+    'text/javascript',
+    'text/html',
+    'text/css',
+    'text/plain',
+    'image/svg+xml'
+    ]
+
+
+#
+# COMPRESSION FUNCTIONS
+#
+def get_supported_encodings():
+    """Return the content encodings the server can produce, best first"""
+
+    if brotli is not None:
+        return ['br', 'gzip']
+
+    return ['gzip']
+
+
+def negotiate_encoding():
+    """Return the best encoding accepted by the client for the current
+       request or None if the response should not be encoded
+    """
+
+    return request.accept_encodings.best_match(get_supported_encodings())
+
+
+def compress(data, encoding):
+    """Compress the bytes with the given content encoding"""
+
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def compress_stream(chunks, encoding):
+    """Compress the chunks of a streamed body as they come. The compressor
+       is flushed after each chunk so the client can show it at once.
+    """
+
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+        return
+
+    # wbits of 31 writes the gzip header and trailer
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def is_compressible(mimetype):
+    """Check if responses of the mimetype are worth compressing"""
+
+    return mimetype in COMPRESSIBLE_MIMETYPES
+
+
+def compress_response(response):
+    """Compress a dynamic response if the client accepts it and the response
+       is big enough. Used as an after_request handler.
+    """
+
+    if (response.status_code != 200 or response.direct_passthrough or
+            'Content-Encoding' in response.headers or
+            not is_compressible(response.mimetype)):
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if response.is_streamed:
+        # Streamed pages are compressed chunk by chunk as they are sent
+        encoding = negotiate_encoding()
+        if encoding is not None:
+            body = response.response
+            response.response = compress_stream(response.iter_encoded(),
+                                                encoding)
+            if hasattr(body, 'close'):
+                response.call_on_close(body.close)
+            response.headers['Content-Encoding'] = encoding
+            response.headers.pop('Content-Length', None)
+        return response
+
+    data = response.get_data()
+    if len(data) < MINIMUM_SIZE:
+        return response
+
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+
+    return response
+
+
+#
+# PRECOMPRESSED BODIES
+#
+class CompressedBody():
+    """A response body kept in memory along with its compressed variants.
+       Since the body is only compressed once, any type of content is tried
+       and a variant is kept when it saves at least a tenth of the size.
+    """
+
+    def __init__(self, data, mimetype):
+        self.data = data
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(data).hexdigest()
+        self.variants = {}
+
+        if len(data) >= MINIMUM_SIZE:
+            for encoding in get_supported_encodings():
+                compressed = compress(data, encoding)
+                if len(compressed) < len(data) * 0.9:
+                    self.variants[encoding] = compressed
+
+    def make_response(self, response_class):
+        """Build the response for the current request using the best variant
+           the client accepts
+        """
+
+        encoding = None
+        if self.variants:
+            encoding = request.accept_encodings.best_match(
+                list(self.variants))
+
+        if encoding is None:
+            response = response_class(self.data, mimetype=self.mimetype)
+        else:
+            response = response_class(self.variants[encoding],
+                                      mimetype=self.mimetype)
+            response.headers['Content-Encoding'] = encoding
+
+        if self.variants:
+            response.vary.add('Accept-Encoding')
+
+        response.set_etag(self.etag)
+        return response.make_conditional(request)
+
+
+class SnapshotCache():
+    """Cache of snapshots of catalog data, such as precompressed response
+       bodies keyed by request path. Entries expire after max_age seconds so
+       that workers that did not make a change themselves eventually serve
+       fresh data.
+    """
+
+    def __init__(self, max_entries=256, max_age=30):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = {}
+
+    def get(self, key):
+        """Return the cached body for the key or None if missing or expired"""
+
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        created, body = entry
+        if time.time() - created > self.max_age:
+            self.entries.pop(key, None)
+            return None
+
+        return body
+
+    def put(self, key, body):
+        """Store the body, dropping the oldest entry when full"""
+
+        if key not in self.entries and len(self.entries) >= self.max_entries:
+            self.entries.pop(next(iter(self.entries)), None)
+
+        self.entries[key] = (time.time(), body)
+
+    def clear(self):
+        """Drop all cached snapshots after the catalog changes"""
+
+        self.entries.clear()
+
+
+def cached_snapshot(cache):
+    """Decorator for views whose successful responses are cached by request
+       path in precompressed form
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def cached_view(*args, **kwargs):
+            key = request.full_path
+
+            body = cache.get(key)
+            if body is None:
+                response = view(*args, **kwargs)
+                if response.status_code != 200:
+                    return response
+
+                body = CompressedBody(response.get_data(), response.mimetype)
+                cache.put(key, body)
+
+            return body.make_response(current_app.response_class)
+
+        return cached_view
+
+    return decorator
+
+
+#
+# STATIC FILES
+#
+def load_static_files(static_folder):
+    """Read and precompress all files in the static folder
+
+       Return value: static_files (dict): CompressedBody per relative filename
+    """
+
+    static_files = {}
+
+    for directory, _, filenames in os.walk(static_folder):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            relative = os.path.relpath(path, static_folder).replace(
+                os.sep, '/')
+
+            mimetype = (mimetypes.guess_type(filename)[0] or
+                        'application/octet-stream')
+            with open(path, 'rb') as static_file:
+                static_files[relative] = CompressedBody(static_file.read(),
+                                                        mimetype)
+
+    return static_files
+
+
+def init_compression(app):
+    """Compress dynamic responses of the app and serve its static files from
+       precompressed copies in memory
+    """
+
+    app.after_request(compress_response)
+
+    static_files = load_static_files(app.static_folder)
+    send_static_file = app.view_functions['static']
+
+    @wraps(send_static_file)
+    def send_precompressed_static_file(filename):
+        body = static_files.get(filename)
+        if body is None:
+            return send_static_file(filename=filename)
+
+        return body.make_response(app.response_class)
+
+    app.view_functions['static'] = send_precompressed_static_file
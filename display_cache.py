@@ -0,0 +1,152 @@
+# DISPLAY_CACHE.PY keeps the details of the most viewed pokemon of the Pokemon
+# Types app in memory, so their pages and JSON responses do not read the
+# database. An entry is dropped as soon as a change to its pokemon, or to a
+# move or category it shows, is committed, and after a time to live so that
+# changes committed by other worker processes are picked up.
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+
+# Most pokemon kept and seconds each is kept by default
+DISPLAY_CACHE_SIZE = int(os.environ.get('DISPLAY_CACHE_SIZE', 1024))
+DISPLAY_CACHE_TTL = float(os.environ.get('DISPLAY_CACHE_TTL', 30))
+
+
+class DisplayCache():
+    """Thread-safe LRU cache of the details of pokemon by ID with a time to
+       live. Each entry lists the rows it shows, ex. ('move', 12), so a
+       change to one of those rows drops it.
+    """
+
+    def __init__(self, max_entries=DISPLAY_CACHE_SIZE, ttl=DISPLAY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Pokemon ID: (expiry time, details, rows shown)
+        self.entries = OrderedDict()
+        # Row shown, ex. ('move', 12): IDs of the pokemon showing it
+        self.dependents = {}
+        # Counts invalidations, so details read before one are not cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get_generation(self):
+        """Return the value to give put for details about to be read"""
+
+        return self.generation
+
+    def get(self, id):
+        """Return the cached details of the pokemon or None if missing or
+           expired
+        """
+
+        with self.lock:
+            entry = self.entries.get(id)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if time.time() >= entry[0]:
+                self.remove_entry(id)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, id, details, rows=(), generation=None):
+        """Cache the details of the pokemon, evicting the least recently
+           used pokemon when full. The details are shared by all callers and
+           must not be changed.
+
+           Args: rows (list): Rows shown besides the pokemon, ex.
+                     [('move', 12), ('category', 3)]
+                 generation (int): get_generation() from before the details
+                     were read. Nothing is cached if an invalidation happened
+                     since, as the details may be out of date.
+        """
+
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            if id in self.entries:
+                self.remove_entry(id)
+
+            rows = frozenset(rows)
+            self.entries[id] = (time.time() + self.ttl, details, rows)
+            for row in rows:
+                self.dependents.setdefault(row, set()).add(id)
+
+            while len(self.entries) > self.max_entries:
+                self.remove_entry(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove_entry(self, id):
+        """Drop the pokemon and its rows. Called with the lock held."""
+
+        _, _, rows = self.entries.pop(id)
+        for row in rows:
+            ids = self.dependents.get(row)
+            if ids is not None:
+                ids.discard(id)
+                if not ids:
+                    del self.dependents[row]
+
+    def invalidate(self, rows):
+        """Drop the pokemon among the changed rows and the pokemon showing
+           any of the rows
+
+           Args: rows (iterable): Changed rows, ex. [('pokemon', 4),
+                 ('move', 12)]
+        """
+
+        with self.lock:
+            self.generation += 1
+            for row in rows:
+                ids = set(self.dependents.get(row, ()))
+                if row[0] == 'pokemon':
+                    ids.add(row[1])
+
+                for id in ids:
+                    if id in self.entries:
+                        self.remove_entry(id)
+                        self.invalidations += 1
+
+    def clear(self):
+        """Drop all pokemon, keeping the counts of hits and misses"""
+
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.dependents.clear()
+
+    def get_stats(self):
+        """Return the size, settings and hit ratio of the cache"""
+
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': (round(float(self.hits) / lookups, 3)
+                              if lookups else 0.0),
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations
+                }
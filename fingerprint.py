@@ -0,0 +1,80 @@
+# FINGERPRINT.PY gives the static files of the Pokemon Types app URLs that
+# contain a hash of their contents. Since a fingerprinted URL changes whenever
+# the file changes, browsers may cache it forever.
+# Ex. static/styles.css is linked as static/styles.3f2a9c01b7de.css
+
+import os
+import hashlib
+from functools import wraps
+
+
+# Length of the content hash added to the filenames
+FINGERPRINT_LENGTH = 12
+
+# Cache header for responses to fingerprinted URLs
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def get_fingerprinted_name(filename, data):
+    """Insert the content hash of the data before the file extension
+
+       Args: filename (str): Ex. "styles.css"
+             data (bytes): Contents of the file
+       Return value: (str): Ex. "styles.3f2a9c01b7de.css"
+    """
+
+    fingerprint = hashlib.sha256(data).hexdigest()[:FINGERPRINT_LENGTH]
+    root, extension = os.path.splitext(filename)
+
+    return '%s.%s%s' % (root, fingerprint, extension)
+
+
+def get_fingerprints(static_folder):
+    """Hash all files in the static folder
+
+       Return value: fingerprints (dict): Fingerprinted name per filename
+    """
+
+    fingerprints = {}
+
+    for directory, _, filenames in os.walk(static_folder):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            relative = os.path.relpath(path, static_folder).replace(
+                os.sep, '/')
+
+            with open(path, 'rb') as static_file:
+                fingerprints[relative] = get_fingerprinted_name(
+                    relative, static_file.read())
+
+    return fingerprints
+
+
+def init_fingerprints(app):
+    """Make url_for('static', ...) emit fingerprinted URLs and serve those
+       URLs with long-lived immutable cache headers
+    """
+
+    fingerprints = get_fingerprints(app.static_folder)
+    original_names = dict((fingerprinted, filename)
+                          for filename, fingerprinted in fingerprints.items())
+
+    @app.url_defaults
+    def add_fingerprint(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in fingerprints:
+            values['filename'] = fingerprints[values['filename']]
+
+    send_static_file = app.view_functions['static']
+
+    @wraps(send_static_file)
+    def send_fingerprinted_static_file(filename):
+        if filename not in original_names:
+            return send_static_file(filename=filename)
+
+        response = app.make_response(
+            send_static_file(filename=original_names[filename]))
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+
+        return response
+
+    app.view_functions['static'] = send_fingerprinted_static_file
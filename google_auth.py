@@ -0,0 +1,180 @@
+# GOOGLE_AUTH.PY talks to the Google OAuth endpoints for the log-in flow of the
+# Pokemon Types app. Connections are pooled and reused across requests, all
+# calls have timeouts and verified token info is cached for a short time.
+# The endpoint URLs may be pointed at a local stub server (see oauth_stub.py).
+
+import os
+import time
+import hashlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+TOKENINFO_URL = os.environ.get(
+    'GOOGLE_TOKENINFO_URL', 'https://www.googleapis.com/oauth2/v1/tokeninfo')
+USERINFO_URL = os.environ.get(
+    'GOOGLE_USERINFO_URL', 'https://www.googleapis.com/oauth2/v1/userinfo')
+REVOKE_URL = os.environ.get(
+    'GOOGLE_REVOKE_URL', 'https://accounts.google.com/o/oauth2/revoke')
+
+# Seconds to wait for a connection and for a response
+TIMEOUT = (3.05, 10)
+
+# Seconds a verified token is trusted without asking Google again. Never
+# longer than the remaining lifetime of the token.
+TOKEN_CACHE_TTL = 300
+
+
+#
+# HTTP CLIENT
+#
+def create_http_session():
+    """Create an HTTP session that keeps connections to the OAuth hosts open
+       for reuse by later requests
+    """
+
+    http_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+
+    return http_session
+
+
+http_session = create_http_session()
+
+
+#
+# TOKEN CACHE
+#
+def get_token_key(access_token):
+    """Tokens are cached by hash so that the tokens themselves are not kept"""
+
+    return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+
+class TokenCache():
+    """Thread-safe cache of data fetched for an access token with a time to
+       live per entry
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, access_token):
+        """Return the cached data for the token or None if missing or
+           expired
+        """
+
+        key = get_token_key(access_token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            expires, data = entry
+            if time.time() >= expires:
+                del self.entries[key]
+                return None
+
+            return data
+
+    def put(self, access_token, data, ttl):
+        """Cache the data for the token for ttl seconds"""
+
+        if ttl <= 0:
+            return
+
+        key = get_token_key(access_token)
+        with self.lock:
+            if key not in self.entries and \
+                    len(self.entries) >= self.max_entries:
+                self.entries.pop(next(iter(self.entries)))
+
+            self.entries[key] = (time.time() + ttl, data)
+
+    def discard(self, access_token):
+        """Forget the token, for example after it has been revoked"""
+
+        with self.lock:
+            self.entries.pop(get_token_key(access_token), None)
+
+
+token_info_cache = TokenCache()
+user_info_cache = TokenCache()
+
+
+#
+# GOOGLE OAUTH ENDPOINTS
+#
+def get_token_ttl(token_info):
+    """Return how long the token info may be cached"""
+
+    try:
+        expires_in = int(token_info.get('expires_in', TOKEN_CACHE_TTL))
+    except (TypeError, ValueError):
+        expires_in = 0
+
+    return min(TOKEN_CACHE_TTL, expires_in)
+
+
+def get_token_info(access_token):
+    """Return the token info of the access token. Errors reported by Google
+       are returned in the 'error' key and are not cached.
+
+       Raises requests.RequestException when Google cannot be reached.
+    """
+
+    token_info = token_info_cache.get(access_token)
+    if token_info is not None:
+        return token_info
+
+    answer = http_session.get(TOKENINFO_URL,
+                              params={'access_token': access_token},
+                              timeout=TIMEOUT)
+    token_info = answer.json()
+
+    if token_info.get('error') is None:
+        token_info_cache.put(access_token, token_info,
+                             get_token_ttl(token_info))
+
+    return token_info
+
+
+def get_user_info(access_token):
+    """Return the Google profile of the user of the access token
+
+       Raises requests.RequestException when Google cannot be reached.
+    """
+
+    user_info = user_info_cache.get(access_token)
+    if user_info is not None:
+        return user_info
+
+    params = {'access_token': access_token, 'alt': 'json'}
+    answer = http_session.get(USERINFO_URL, params=params, timeout=TIMEOUT)
+    answer.raise_for_status()
+    user_info = answer.json()
+
+    token_info = token_info_cache.get(access_token) or {}
+    user_info_cache.put(access_token, user_info, get_token_ttl(token_info))
+
+    return user_info
+
+
+def revoke_token(access_token):
+    """Revoke the access token and return True if Google accepted it
+
+       Raises requests.RequestException when Google cannot be reached.
+    """
+
+    token_info_cache.discard(access_token)
+    user_info_cache.discard(access_token)
+
+    answer = http_session.get(REVOKE_URL, params={'token': access_token},
+                              timeout=TIMEOUT)
+
+    return answer.status_code == 200
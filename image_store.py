@@ -0,0 +1,344 @@
+# IMAGE_STORE.PY keeps pokemon images for the Pokemon Types app in a local
+# content-addressed store, so pages do not load full-size images from remote
+# hosts. Images are uploaded or ingested from their URLs once, stored under
+# the hash of their contents and shrunk to thumbnails for the tiles and the
+# details page on a background pool. Since a file name changes whenever its
+# contents change, browsers may cache the files forever.
+# Thumbnails need Pillow. Without it the stored originals are shown instead.
+
+import os
+import re
+import time
+import hashlib
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, wait
+import requests
+from database_setup import Pokemon, StoredImage
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Directory of the store
+IMAGE_STORE_DIR = os.environ.get('IMAGE_STORE_DIR', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'image_store'))
+
+# Directory local images may be ingested from. Local files are not read when
+# it is not set.
+IMAGE_IMPORT_DIR = os.environ.get('IMAGE_IMPORT_DIR')
+
+# Largest image stored, in bytes
+MAX_IMAGE_SIZE = 5 * 1024 * 1024
+
+# Seconds to wait for a connection and for a response when ingesting
+TIMEOUT = (3.05, 10)
+
+# Name of each thumbnail size and the largest width and height in pixels.
+# Twice the size shown, for high-density screens.
+THUMBNAIL_SIZES = [
+    ('tile', 240),
+    ('detail', 400)
+    ]
+
+# Threads making thumbnails
+THUMBNAIL_WORKERS = 2
+
+# File extension and mimetype of each image format, by its first bytes
+IMAGE_FORMATS = [
+    (b'\x89PNG\r\n\x1a\n', 'png', 'image/png'),
+    (b'\xff\xd8\xff', 'jpg', 'image/jpeg'),
+    (b'GIF87a', 'gif', 'image/gif'),
+    (b'GIF89a', 'gif', 'image/gif'),
+    (b'RIFF', 'webp', 'image/webp')
+    ]
+
+IMAGE_MIMETYPES = dict((extension, mimetype)
+                       for _, extension, mimetype in IMAGE_FORMATS)
+
+# Ex. '3f2a...9c.png' or '3f2a...9c.tile.png'
+IMAGE_NAME = re.compile(r'^[0-9a-f]{64}(\.(%s))?\.(%s)$' % (
+    '|'.join(size for size, _ in THUMBNAIL_SIZES),
+    '|'.join(IMAGE_MIMETYPES)))
+
+
+class ImageError(Exception):
+    """Images that cannot be read or stored"""
+
+
+#
+# STORE FILES
+#
+def get_image_extension(data):
+    """Return the file extension of the image format of the data
+
+       Raises ImageError if the data is not a PNG, JPEG, GIF or WebP image
+    """
+
+    for prefix, extension, _ in IMAGE_FORMATS:
+        if data.startswith(prefix):
+            if extension == 'webp' and data[8:12] != b'WEBP':
+                continue
+            return extension
+
+    raise ImageError('Images must be PNG, JPEG, GIF or WebP files.')
+
+
+def is_image_name(name):
+    """Check if the name is of a file of the store"""
+
+    return bool(IMAGE_NAME.match(name))
+
+
+def get_image_mimetype(name):
+    """Return the mimetype of the stored file"""
+
+    return IMAGE_MIMETYPES[name.rsplit('.', 1)[1]]
+
+
+def get_store_path(name, directory=IMAGE_STORE_DIR):
+    """Return the path of the stored file. Files are spread over
+       subdirectories by the first characters of their hash.
+    """
+
+    return os.path.join(directory, name[:2], name)
+
+
+def write_store_file(path, data):
+    """Write the file atomically, so no request reads half of it"""
+
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    temporary_path = '%s.%s.%s.tmp' % (path, os.getpid(),
+                                       threading.get_ident())
+    with open(temporary_path, 'wb') as store_file:
+        store_file.write(data)
+    os.replace(temporary_path, path)
+
+
+def store_image(data, directory=IMAGE_STORE_DIR):
+    """Add the image to the store unless it is there already
+
+       Return value: (str): Name of the stored file. Ex. '3f2a...9c.png'
+       Raises ImageError for files too large or not images
+    """
+
+    if len(data) > MAX_IMAGE_SIZE:
+        raise ImageError('Images may be at most %s MB.'
+                         % (MAX_IMAGE_SIZE // (1024 * 1024)))
+
+    name = '%s.%s' % (hashlib.sha256(data).hexdigest(),
+                      get_image_extension(data))
+    path = get_store_path(name, directory)
+    if not os.path.exists(path):
+        write_store_file(path, data)
+
+    return name
+
+
+def read_image_source(source):
+    """Read the image at an http or https URL, or at a path or file:// URL
+       inside IMAGE_IMPORT_DIR
+
+       Return value: (bytes): At most MAX_IMAGE_SIZE + 1 bytes, so images too
+                     large are refused by store_image
+       Raises ImageError if the image cannot be read
+    """
+
+    if source.startswith(('http://', 'https://')):
+        try:
+            response = requests.get(source, timeout=TIMEOUT, stream=True)
+            response.raise_for_status()
+            return response.raw.read(MAX_IMAGE_SIZE + 1, decode_content=True)
+        except requests.RequestException as error:
+            raise ImageError('Could not fetch %s: %s' % (source, error))
+
+    if not IMAGE_IMPORT_DIR:
+        raise ImageError('Local images are only read from IMAGE_IMPORT_DIR.')
+
+    import_dir = os.path.realpath(IMAGE_IMPORT_DIR)
+    if source.startswith('file://'):
+        source = source[len('file://'):]
+    path = os.path.realpath(os.path.join(import_dir, source))
+    if os.path.commonpath([import_dir, path]) != import_dir:
+        raise ImageError('%s is outside IMAGE_IMPORT_DIR.' % source)
+
+    try:
+        with open(path, 'rb') as image_file:
+            return image_file.read(MAX_IMAGE_SIZE + 1)
+    except IOError as error:
+        raise ImageError('Could not read %s: %s' % (source, error))
+
+
+#
+# THUMBNAILS
+#
+def get_thumbnail_name(name, size):
+    """Return the name of the thumbnail of the stored image at the size.
+       GIF images get PNG thumbnails of their first frame.
+
+       Ex. '3f2a...9c.gif', 'tile' -> '3f2a...9c.tile.png'
+    """
+
+    digest, extension = name.split('.')
+    if extension == 'gif':
+        extension = 'png'
+
+    return '%s.%s.%s' % (digest, size, extension)
+
+
+def make_thumbnails(name, directory=IMAGE_STORE_DIR):
+    """Make the missing thumbnails of the stored image. Images smaller than
+       a thumbnail size are only re-encoded.
+
+       Return value: (list): Names of the thumbnails made
+    """
+
+    if Image is None:
+        return []
+
+    made = []
+    for size, pixels in THUMBNAIL_SIZES:
+        thumbnail_name = get_thumbnail_name(name, size)
+        path = get_store_path(thumbnail_name, directory)
+        if os.path.exists(path):
+            continue
+
+        output = BytesIO()
+        extension = thumbnail_name.rsplit('.', 1)[1]
+        try:
+            with Image.open(get_store_path(name, directory)) as image:
+                image.thumbnail((pixels, pixels))
+                if extension == 'jpg':
+                    image.convert('RGB').save(output, 'JPEG', quality=85,
+                                              optimize=True)
+                elif extension == 'webp':
+                    image.save(output, 'WEBP', quality=85)
+                else:
+                    if image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+                        image = image.convert('RGBA')
+                    image.save(output, 'PNG', optimize=True)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            # Images Pillow cannot decode keep showing the original
+            return made
+
+        write_store_file(path, output.getvalue())
+        made.append(thumbnail_name)
+
+    return made
+
+
+# Thumbnails are made in the background, so uploads do not wait for them
+thumbnail_pool = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS,
+                                     thread_name_prefix='thumbnail')
+
+
+def queue_thumbnails(name):
+    """Make the thumbnails of the stored image on the thumbnail pool
+
+       Return value: (Future): Done once the thumbnails are made
+    """
+
+    return thumbnail_pool.submit(make_thumbnails, name)
+
+
+#
+# INGESTION
+#
+def ingest_images(session, report=None):
+    """Copy the images of the pokemon not in the store yet into it and make
+       their thumbnails. The caller commits.
+
+       Args: report (function): Called with the number of images done and the
+                 total after each image
+       Return value: (tuple): Numbers of images stored and failed
+    """
+
+    stored_sources = set(source for source, in session.query(
+        StoredImage.source))
+    sources = sorted(set(image for image, in session.query(
+        Pokemon.image).distinct()).difference(stored_sources))
+
+    stored = 0
+    failed = 0
+    futures = []
+    for number, source in enumerate(sources):
+        try:
+            name = store_image(read_image_source(source))
+        except ImageError:
+            failed += 1
+        else:
+            session.add(StoredImage(source=source, name=name))
+            futures.append(queue_thumbnails(name))
+            stored += 1
+
+        if report is not None:
+            report(number + 1, len(sources))
+
+    wait(futures)
+    return stored, failed
+
+
+#
+# IMAGE INDEX
+#
+class ImageIndex():
+    """Stored image of each Pokemon.image value, loaded with a single query
+       and kept until images are added, or for max_age seconds to pick up
+       images added by other worker processes
+    """
+
+    def __init__(self, max_age=30):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Load the stored images from the database again on the next
+           lookup
+        """
+
+        with self.lock:
+            self.loaded = 0
+            self.names = {}
+            self.thumbnails = set()
+
+    def load(self, session):
+        """Load the name of the stored image of each source"""
+
+        names = dict(session.query(StoredImage.source, StoredImage.name))
+
+        with self.lock:
+            self.names = names
+            self.thumbnails = set()
+            self.loaded = time.time()
+
+    def get_name(self, image, size, session):
+        """Return the stored file to show for the image at the size: its
+           thumbnail once made, else the original
+
+           Args: image (str): Value of Pokemon.image
+                 size (str): Ex. 'tile'
+           Return value: (str): Name of the stored file or None if the image
+                         is not stored
+        """
+
+        if time.time() - self.loaded > self.max_age:
+            self.load(session)
+
+        name = self.names.get(image)
+        if name is None or Image is None:
+            return name
+
+        thumbnail_name = get_thumbnail_name(name, size)
+        if thumbnail_name in self.thumbnails:
+            return thumbnail_name
+        if os.path.exists(get_store_path(thumbnail_name)):
+            self.thumbnails.add(thumbnail_name)
+            return thumbnail_name
+
+        return name
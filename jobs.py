@@ -0,0 +1,287 @@
+# JOBS.PY runs the maintenance tasks of the Pokemon Types app in the
+# background, so that long tasks such as cleanup on a large catalog do not
+# tie up a web server worker. Jobs are kept in the job table with their
+# status and progress, and rows are changed in bounded batches, each in its
+# own transaction, so no task holds locks for long.
+
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from sqlalchemy import asc, update, exists
+from database_setup import (
+    engine,
+    Job,
+    Pokemon,
+    PokemonDisplay,
+    Category,
+    Move,
+    utc_now
+    )
+from view_model import refresh_pokemon_displays
+from column_types import integer_list_contains
+from change_log import log_changes
+from catalog_snapshot import write_catalog_snapshot
+from migrate_list_columns import migrate_list_columns
+from image_store import ingest_images
+
+
+# Most rows changed per transaction
+JOB_BATCH_SIZE = 200
+
+# Jobs run one at a time so maintenance never competes with itself
+JOB_WORKERS = 1
+
+
+class JobContext():
+    """Passed to a running job to report its progress"""
+
+    def __init__(self, session, job):
+        self.session = session
+        self.job = job
+
+    def report(self, done=None, total=None, message=None):
+        """Commit the current batch of the job along with its progress"""
+
+        if done is not None:
+            self.job.done = done
+        if total is not None:
+            self.job.total = total
+        if message is not None:
+            self.job.message = message[:250]
+        self.session.commit()
+
+
+#
+# MAINTENANCE TASKS
+#
+def find_unused(session):
+    """Find the categories and moves no pokemon uses any longer. Only the
+       needed columns are read and the query count stays the same no matter
+       how many pokemon there are.
+
+       Return value: (tuple): Lists of (id, name) of the unused categories
+                     and of the unused moves, in alphabetical order
+    """
+
+    categories_used = set(category_id for category_id, in
+                          session.query(Pokemon.category_id).distinct())
+    moves_used = set()
+    for move_list, in session.query(Pokemon.move_list):
+        moves_used.update(move_list or [])
+
+    unused_categories = [
+        (id, name) for id, name in session.query(
+            Category.id, Category.name).order_by(asc(Category.name))
+        if id not in categories_used]
+    unused_moves = [
+        (id, name) for id, name in session.query(
+            Move.id, Move.name).order_by(asc(Move.name))
+        if id not in moves_used]
+
+    return unused_categories, unused_moves
+
+
+def run_cleanup(context):
+    """Delete the unused categories and moves. Each batch is checked again
+       as it is deleted, so rows a pokemon started using since find_unused
+       are kept.
+    """
+
+    session = context.session
+    unused_categories, unused_moves = find_unused(session)
+    context.report(0, len(unused_categories) + len(unused_moves))
+
+    still_unused = {
+        'category': ~exists().where(Pokemon.category_id == Category.id),
+        'move': ~exists().where(integer_list_contains(Pokemon.move_list,
+                                                      Move.id))
+        }
+
+    done = 0
+    deleted = {'category': 0, 'move': 0}
+    for model, kind, unused in [(Category, 'category', unused_categories),
+                                (Move, 'move', unused_moves)]:
+        ids = [id for id, _ in unused]
+        for start in range(0, len(ids), JOB_BATCH_SIZE):
+            batch = ids[start:start + JOB_BATCH_SIZE]
+
+            session.query(model).filter(
+                model.id.in_(batch), still_unused[kind]).delete(
+                    synchronize_session=False)
+            kept = set(id for id, in session.query(model.id).filter(
+                model.id.in_(batch)))
+            batch_deleted = [id for id in batch if id not in kept]
+
+            # Bulk deletes skip the session, so the change feed is told here
+            if batch_deleted:
+                log_changes(session, kind, batch_deleted, is_deleted=True)
+            deleted[kind] += len(batch_deleted)
+
+            done += len(batch)
+            context.report(done)
+
+    context.report(message='Deleted %s categories and %s moves'
+                   % (deleted['category'], deleted['move']))
+    write_catalog_snapshot(session)
+
+
+def run_reindex(context):
+    """Write the display rows of all pokemon again, drop display rows of
+       deleted pokemon and create missing database indexes. In-memory
+       indexes are loaded again once the job is done.
+    """
+
+    session = context.session
+    ids = [id for id, in session.query(Pokemon.id).order_by(Pokemon.id)]
+    context.report(0, len(ids))
+
+    for start in range(0, len(ids), JOB_BATCH_SIZE):
+        batch = ids[start:start + JOB_BATCH_SIZE]
+        refresh_pokemon_displays(session.query(Pokemon).filter(
+            Pokemon.id.in_(batch)).all(), session)
+        context.report(start + len(batch))
+
+    id_set = set(ids)
+    orphans = [id for id, in session.query(PokemonDisplay.id)
+               if id not in id_set]
+    for start in range(0, len(orphans), JOB_BATCH_SIZE):
+        session.query(PokemonDisplay).filter(PokemonDisplay.id.in_(
+            orphans[start:start + JOB_BATCH_SIZE])).delete(
+                synchronize_session=False)
+        session.commit()
+
+    for index in Pokemon.__table__.indexes:
+        index.create(engine, checkfirst=True)
+
+    context.report(message='Rebuilt %s display rows' % len(ids))
+    write_catalog_snapshot(session)
+
+
+def run_snapshot(context):
+    """Write the catalog snapshot even if it looks up to date"""
+
+    write_catalog_snapshot(context.session, force=True)
+    context.report(message='Snapshot written')
+
+
+def run_migrate(context):
+    """Migrate the list columns of the pokemon table still holding pickled
+       lists
+    """
+
+    migrate_list_columns(JOB_BATCH_SIZE,
+                         report=lambda message: context.report(
+                             message=message))
+
+
+def run_images(context):
+    """Copy the images of the pokemon into the local image store and make
+       their thumbnails
+    """
+
+    def report(done, total):
+        if done % JOB_BATCH_SIZE == 0 or done == total:
+            context.report(done, total)
+
+    stored, failed = ingest_images(context.session, report)
+    context.report(message='Stored %s images, %s could not be read'
+                   % (stored, failed))
+
+
+# Task of each kind of job and whether it changes the catalog
+JOB_KINDS = {
+    'cleanup': (run_cleanup, True),
+    'reindex': (run_reindex, True),
+    'snapshot': (run_snapshot, False),
+    'migrate': (run_migrate, True),
+    'images': (run_images, True)
+    }
+
+
+#
+# JOB RUNNER
+#
+class JobRunner():
+    """Runs jobs on worker threads, each with its own database session.
+       catalog_changed is called after a job changing the catalog is done,
+       to drop data cached from the catalog.
+    """
+
+    def __init__(self, session_factory, catalog_changed=None,
+                 workers=JOB_WORKERS):
+        self.session_factory = session_factory
+        self.catalog_changed = catalog_changed
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='job')
+        self.futures = []
+
+    def submit(self, session, kind):
+        """Queue a job of the kind, committing it in the session
+
+           Return value: (Job): The queued job
+        """
+
+        if kind not in JOB_KINDS:
+            raise ValueError('Unknown job kind %s.' % kind)
+
+        job = Job(kind=kind, status='queued')
+        session.add(job)
+        session.commit()
+
+        self.start(job.id)
+        return job
+
+    def start(self, job_id):
+        """Hand the job to a worker thread"""
+
+        self.futures = [future for future in self.futures
+                        if not future.done()]
+        self.futures.append(self.executor.submit(self.run, job_id))
+
+    def resume_queued(self, session):
+        """Start the jobs queued before the server restarted. A job started
+           by several processes is only run by the first one to claim it.
+        """
+
+        for id, in session.query(Job.id).filter_by(
+                status='queued').order_by(Job.id):
+            self.start(id)
+
+    def run(self, job_id):
+        """Run the job unless another worker claimed it first"""
+
+        session = self.session_factory()
+        try:
+            claimed = session.execute(update(Job).where(
+                Job.id == job_id, Job.status == 'queued').values(
+                    status='running', started_at=utc_now()))
+            session.commit()
+            if claimed.rowcount != 1:
+                return
+
+            job = session.query(Job).filter_by(id=job_id).one()
+            task, changes_catalog = JOB_KINDS[job.kind]
+            start = time.perf_counter()
+            try:
+                task(JobContext(session, job))
+            except Exception as error:
+                session.rollback()
+                job.status = 'failed'
+                job.message = ('%s: %s' % (type(error).__name__,
+                                           error))[:250]
+            else:
+                job.status = 'done'
+                if not job.message:
+                    job.message = 'Done in %.1f s' % (
+                        time.perf_counter() - start)
+            job.finished_at = utc_now()
+            session.commit()
+
+            if changes_catalog and self.catalog_changed is not None:
+                self.catalog_changed()
+        finally:
+            session.close()
+
+    def wait(self, timeout=None):
+        """Wait for the started jobs to finish"""
+
+        wait(self.futures, timeout)
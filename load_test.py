@@ -0,0 +1,369 @@
+# LOAD_TEST.PY replays a realistic mix of traffic against a running instance
+# of the Pokemon Types app with a growing number of concurrent virtual users,
+# and reports throughput, latency percentiles and error rates at each level.
+# It only talks to the app, so it runs entirely offline.
+#
+# Edits go through the stub log-in, so start the app with STUB_LOGIN=1 to
+# include them. Without it the mix has no edits.
+#
+# The virtual users all come from one address, which the app rate limits as a
+# single client. Each sends its own API key, load-test-1, load-test-2, etc.,
+# so listing them in API_KEYS limits each user on its own. Start the app with
+# RATE_LIMIT=0 to measure it without rate limits.
+#
+# Usage: python load_test.py [seconds per level] [concurrency levels]
+# Ex. python load_test.py 10 1,2,4,8,16,32
+# The app is expected in http://localhost:8000 unless LOAD_TEST_URL is set.
+
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import threading
+import http.client
+from urllib.parse import urlparse, urlencode
+
+
+BASE_URL = os.environ.get('LOAD_TEST_URL', 'http://localhost:8000')
+
+# Prefix of the API key of each virtual user
+API_KEY_PREFIX = 'load-test-'
+
+# Status of the requests turned away by a rate or concurrency limit
+RATE_LIMITED_STATUS = 429
+
+DEFAULT_DURATION = 10
+DEFAULT_LEVELS = [1, 2, 4, 8, 16, 32]
+
+# Relative weights of the scenarios in the traffic mix
+SCENARIO_WEIGHTS = [
+    ('home', 30),
+    ('type', 25),
+    ('details', 25),
+    ('json', 15),
+    ('edit', 5)
+    ]
+
+# A level is saturated when adding users no longer adds this much throughput
+SATURATION_GAIN = 1.1
+
+# Pokedex IDs for the entries the virtual users create to edit
+LOAD_TEST_POKEDEX_ID = 90000
+
+
+#
+# HTTP CLIENT
+#
+class VirtualUser(object):
+    """Browser-like client with its own keep-alive connection and cookies"""
+
+    def __init__(self, number):
+        url = urlparse(BASE_URL)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.number = number
+        self.connection = None
+        self.cookies = {}
+        self.pokemon_id = None
+
+    def request(self, method, path, form=None):
+        """Send the request and return the status code and body. Redirects
+           are not followed.
+        """
+
+        headers = {'Accept-Encoding': 'gzip',
+                   'X-API-Key': '%s%s' % (API_KEY_PREFIX, self.number)}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookies:
+            headers['Cookie'] = '; '.join('%s=%s' % item
+                                          for item in self.cookies.items())
+
+        # A dropped keep-alive connection is reopened once
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(
+                    self.host, self.port, timeout=30)
+            try:
+                self.connection.request(method, path, body, headers)
+                response = self.connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if attempt:
+                    raise
+
+        for header, value in response.getheaders():
+            if header.lower() == 'set-cookie':
+                name, _, rest = value.partition('=')
+                self.cookies[name] = rest.split(';')[0]
+        if response.getheader('Connection', '').lower() == 'close':
+            self.close()
+        if response.getheader('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+
+        return response.status, data
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+#
+# SCENARIOS
+#
+class Catalog(object):
+    """IDs and type names to pick pages from, read from the JSON API"""
+
+    def __init__(self, user):
+        status, data = user.request('GET', '/pokemon/json?fields=id')
+        if status != 200:
+            raise RuntimeError('Could not read the catalog: HTTP %s' % status)
+        self.pokemon_ids = [pokemon['id']
+                            for pokemon in json.loads(data)['Pokemon']]
+
+        status, data = user.request('GET', '/pokemon/type/json')
+        self.type_names = [type['name'].lower()
+                           for type in json.loads(data)['Types']]
+
+        if not self.pokemon_ids or not self.type_names:
+            raise RuntimeError('The catalog is empty. Run initial_entries.py '
+                               'first.')
+
+
+def make_pokemon_form(user, edit_count=0):
+    """Return the form for the entry owned by the virtual user"""
+
+    return {
+        'pokedex_id': str(LOAD_TEST_POKEDEX_ID + user.number),
+        'name': 'Loadtest %s' % user.number,
+        'description': 'Entry edited by the load test %s times' % edit_count,
+        'image': 'https://example.com/loadtest.png',
+        'height_ft': '2',
+        'height_inch': str(edit_count % 12),
+        'weight': '10.0',
+        'evolution_before': '0',
+        'evolution_after': '',
+        'type': 'Normal',
+        'weakness': 'Fighting',
+        'move': 'Tackle',
+        'category': 'Load Test'
+        }
+
+
+def log_in(user):
+    """Log the virtual user in with the stub log-in and add an entry it may
+       edit. Return False when the app has no stub log-in.
+    """
+
+    status, _ = user.request('POST', '/pokemon/login/stub', {
+        'email': 'loadtest-%s@example.com' % user.number,
+        'username': 'Load Test %s' % user.number})
+    if status != 200:
+        return False
+
+    status, _ = user.request('POST', '/pokemon/new', make_pokemon_form(user))
+    if status != 302:
+        return False
+
+    # The Pokedex ID is unique to the user, so the entry is found with it
+    status, data = user.request(
+        'GET', '/pokemon/json?' + urlencode({'fields': 'id,pokedex_id'}))
+    for pokemon in json.loads(data)['Pokemon']:
+        if pokemon['pokedex_id'] == LOAD_TEST_POKEDEX_ID + user.number:
+            user.pokemon_id = pokemon['id']
+
+    return user.pokemon_id is not None
+
+
+def log_out(user):
+    """Delete the entry added by the virtual user"""
+
+    if user.pokemon_id is not None:
+        user.request('POST', '/pokemon/%s/delete' % user.pokemon_id, {})
+        user.pokemon_id = None
+
+
+def run_scenario(name, user, catalog, generator):
+    """Make the requests of the scenario and return the status code of the
+       last one
+    """
+
+    if name == 'home':
+        return user.request('GET', '/pokemon/')[0]
+
+    if name == 'type':
+        type_name = generator.choice(catalog.type_names)
+        return user.request('GET', '/pokemon/%s' % type_name)[0]
+
+    if name == 'details':
+        id = generator.choice(catalog.pokemon_ids)
+        return user.request('GET', '/pokemon/%s' % id)[0]
+
+    if name == 'json':
+        path = generator.choice([
+            '/pokemon/json',
+            '/pokemon/%s/json' % generator.choice(catalog.type_names),
+            '/pokemon/%s/json' % generator.choice(catalog.pokemon_ids),
+            '/pokemon/facets/json'])
+        return user.request('GET', path)[0]
+
+    if name == 'edit':
+        status, _ = user.request('GET', '/pokemon/%s/edit' % user.pokemon_id)
+        if status != 200:
+            return status
+        return user.request(
+            'POST', '/pokemon/%s/edit' % user.pokemon_id,
+            make_pokemon_form(user, generator.randint(1, 1000)))[0]
+
+
+# Expected status codes of each scenario
+SCENARIO_STATUSES = {
+    'home': (200,),
+    'type': (200,),
+    'details': (200,),
+    'json': (200,),
+    'edit': (302,)
+    }
+
+
+#
+# LOAD LEVELS
+#
+def percentile(timings, fraction):
+    """Return the value below which the fraction of the sorted timings fall"""
+
+    if not timings:
+        return 0
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def run_level(concurrency, duration, catalog, users):
+    """Run the traffic mix with the number of concurrent users for the
+       duration in seconds
+
+       Return value: (dict): Throughput, latency percentiles in ms, the
+                     error rate and the number of requests rate limited
+    """
+
+    names = [name for name, weight in SCENARIO_WEIGHTS
+             if name != 'edit' or users[0].pokemon_id is not None]
+    weights = [weight for name, weight in SCENARIO_WEIGHTS if name in names]
+
+    timings = []
+    errors = [0]
+    limited = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def user_loop(user):
+        generator = random.Random(user.number)
+        user_timings = []
+        user_errors = 0
+        user_limited = 0
+
+        while time.perf_counter() < deadline:
+            name = generator.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = run_scenario(name, user, catalog, generator)
+            except (http.client.HTTPException, OSError):
+                status = None
+            user_timings.append((time.perf_counter() - start) * 1000)
+            if status not in SCENARIO_STATUSES[name]:
+                user_errors += 1
+            if status == RATE_LIMITED_STATUS:
+                user_limited += 1
+
+        with lock:
+            timings.extend(user_timings)
+            errors[0] += user_errors
+            limited[0] += user_limited
+
+    threads = [threading.Thread(target=user_loop, args=(user,))
+               for user in users[:concurrency]]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    timings.sort()
+    return {'requests': len(timings),
+            'throughput': len(timings) / elapsed,
+            'p50': percentile(timings, 0.50),
+            'p95': percentile(timings, 0.95),
+            'p99': percentile(timings, 0.99),
+            'error_rate': errors[0] / len(timings) if timings else 0,
+            'limited': limited[0]}
+
+
+def run_sweep(duration, levels):
+    """Run each concurrency level in turn and print a line per level. A level
+       is flagged as saturated once more users stop adding throughput.
+    """
+
+    setup_user = VirtualUser(0)
+    catalog = Catalog(setup_user)
+    setup_user.close()
+
+    users = [VirtualUser(number) for number in range(1, max(levels) + 1)]
+    if all([log_in(user) for user in users]):
+        print('Edits enabled for %s virtual users' % len(users))
+    else:
+        print('Stub log-in not available, edits are left out of the mix. '
+              'Start the app with STUB_LOGIN=1 to include them.')
+        for user in users:
+            log_out(user)
+
+    print('%8s %10s %10s %10s %10s %10s %8s' % (
+        'users', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+
+    best_throughput = 0
+    limited = 0
+    try:
+        for concurrency in levels:
+            result = run_level(concurrency, duration, catalog, users)
+
+            note = ''
+            if best_throughput and (result['throughput'] <
+                                    best_throughput * SATURATION_GAIN):
+                note = '  saturated'
+            best_throughput = max(best_throughput, result['throughput'])
+            limited += result['limited']
+
+            print('%8d %10d %10.1f %10.1f %10.1f %10.1f %7.1f%%%s' % (
+                concurrency, result['requests'], result['throughput'],
+                result['p50'], result['p95'], result['p99'],
+                result['error_rate'] * 100, note))
+    finally:
+        for user in users:
+            log_out(user)
+            user.close()
+
+    if limited:
+        print('%s requests were rate limited and counted as errors. Start the '
+              'app with RATE_LIMIT=0, or list the keys %s1 to %s%s in '
+              'API_KEYS to limit each virtual user on its own.' % (
+                  limited, API_KEY_PREFIX, API_KEY_PREFIX, len(users)))
+
+
+#
+# MAIN FUNCTION
+#
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_DURATION
+    if len(sys.argv) > 2:
+        levels = [int(level) for level in sys.argv[2].split(',')]
+    else:
+        levels = DEFAULT_LEVELS
+
+    print('Load testing %s for %s seconds per level' % (BASE_URL, duration))
+    run_sweep(duration, levels)
@@ -0,0 +1,163 @@
+# MIGRATE_LIST_COLUMNS.PY rewrites the list columns of the pokemon table from
+# pickled Python lists to the IntegerList column type, which stores them as
+# INTEGER[] on PostgreSQL and as packed integers on SQLite. Rows are rewritten
+# in batches, each in its own transaction, so the table is never locked for
+# long. Running it again resumes an interrupted migration and skips columns
+# already migrated.
+#
+# Usage: python migrate_list_columns.py [batch size]
+
+import sys
+import pickle
+from sqlalchemy import text, bindparam
+from database_setup import engine, Pokemon
+from column_types import IntegerList
+
+
+# List columns of the pokemon table and whether they may be NULL
+LIST_COLUMNS = [
+    ('evolution_after_list', True),
+    ('type_list', False),
+    ('weakness_list', False),
+    ('move_list', False)
+    ]
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def decode_pickled_list(value):
+    """Return the pickled list as integers. Older rows may hold the IDs as
+       strings. Items that are not numbers are dropped.
+    """
+
+    integer_list = []
+    for item in pickle.loads(value):
+        try:
+            integer_list.append(int(item))
+        except (TypeError, ValueError):
+            continue
+
+    return integer_list
+
+
+def is_pickled(value):
+    """Check if the stored value is a pickled list"""
+
+    try:
+        return isinstance(pickle.loads(value), list)
+    except Exception:
+        return False
+
+
+def get_column_names(connection):
+    """Return the names of the columns of the pokemon table"""
+
+    if connection.dialect.name == 'postgresql':
+        rows = connection.execute(text(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_name = 'pokemon'"))
+    else:
+        rows = connection.execute(text("SELECT name FROM pragma_table_info("
+                                       "'pokemon')"))
+
+    return [row[0] for row in rows]
+
+
+def needs_migration(connection, column):
+    """Check if the column still holds pickled lists"""
+
+    if column + '_migrated' in get_column_names(connection):
+        # An earlier run was interrupted
+        return True
+
+    if connection.dialect.name == 'postgresql':
+        data_type = connection.execute(text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_name = 'pokemon' AND column_name = :column"),
+            {'column': column}).scalar()
+        return data_type != 'ARRAY'
+
+    value = connection.execute(text(
+        'SELECT %s FROM pokemon WHERE %s IS NOT NULL LIMIT 1'
+        % (column, column))).scalar()
+    return value is not None and is_pickled(value)
+
+
+def migrate_column(column, nullable, batch_size, report=print):
+    """Copy the decoded lists of the column into a new column in batches,
+       then replace the old column with it. report is called with a
+       progress message after each batch.
+    """
+
+    migrated = column + '_migrated'
+
+    with engine.begin() as connection:
+        if migrated not in get_column_names(connection):
+            if connection.dialect.name == 'postgresql':
+                column_type = 'INTEGER[]'
+            else:
+                column_type = 'BLOB'
+            connection.execute(text('ALTER TABLE pokemon ADD COLUMN %s %s'
+                                    % (migrated, column_type)))
+
+    select_batch = text(
+        'SELECT id, %s FROM pokemon WHERE %s IS NULL AND %s IS NOT NULL '
+        'AND id > :last_id ORDER BY id LIMIT :batch_size'
+        % (column, migrated, column))
+    update_row = text(
+        'UPDATE pokemon SET %s = :value WHERE id = :id'
+        % migrated).bindparams(bindparam('value', type_=IntegerList()))
+
+    last_id = 0
+    count = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(select_batch, {
+                'last_id': last_id, 'batch_size': batch_size}).fetchall()
+            if not rows:
+                break
+
+            connection.execute(update_row, [
+                {'id': id, 'value': decode_pickled_list(value)}
+                for id, value in rows])
+
+        last_id = rows[-1][0]
+        count += len(rows)
+        report('%s: %s rows rewritten' % (column, count))
+
+    # Swap the columns in a single transaction
+    with engine.begin() as connection:
+        connection.execute(text('ALTER TABLE pokemon DROP COLUMN %s'
+                                % column))
+        connection.execute(text('ALTER TABLE pokemon RENAME COLUMN %s TO %s'
+                                % (migrated, column)))
+        if not nullable and connection.dialect.name == 'postgresql':
+            connection.execute(text(
+                'ALTER TABLE pokemon ALTER COLUMN %s SET NOT NULL' % column))
+
+
+def migrate_list_columns(batch_size=DEFAULT_BATCH_SIZE, report=print):
+    """Migrate all list columns still holding pickled lists"""
+
+    for column, nullable in LIST_COLUMNS:
+        with engine.connect() as connection:
+            if not needs_migration(connection, column):
+                report('%s: already migrated' % column)
+                continue
+
+        migrate_column(column, nullable, batch_size, report)
+        report('%s: migrated' % column)
+
+    # Indexes on the list columns can only be created once migrated
+    for index in Pokemon.__table__.indexes:
+        index.create(engine, checkfirst=True)
+
+
+#
+# MAIN FUNCTION
+#
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        migrate_list_columns(int(sys.argv[1]))
+    else:
+        migrate_list_columns()
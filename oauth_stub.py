@@ -0,0 +1,92 @@
+# OAUTH_STUB.PY is a local stand-in for the Google OAuth endpoints used by the
+# log-in flow of the Pokemon Types app. It allows the log-in to be tested and
+# benchmarked offline.
+#
+# Access tokens are accepted when they look like "stub-<user id>".
+#
+# Usage: python oauth_stub.py [port] [latency in ms]
+# Then run the app with:
+#   GOOGLE_TOKENINFO_URL=http://localhost:<port>/oauth2/v1/tokeninfo
+#   GOOGLE_USERINFO_URL=http://localhost:<port>/oauth2/v1/userinfo
+#   GOOGLE_REVOKE_URL=http://localhost:<port>/o/oauth2/revoke
+
+import sys
+import json
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+CLIENT_ID = json.loads(
+    open('client_secrets.json', 'r').read())['web']['client_id']
+
+TOKEN_PREFIX = 'stub-'
+
+
+class OAuthStubHandler(BaseHTTPRequestHandler):
+    """Answers tokeninfo, userinfo and revoke requests"""
+
+    # HTTP/1.1 keeps connections open so pooled clients can reuse them
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    # Simulated network and processing delay in seconds
+    latency = 0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        token = (params.get('access_token') or params.get('token') or [''])[0]
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if not token.startswith(TOKEN_PREFIX):
+            self.send_json(400, {'error': 'invalid_token'})
+        elif url.path == '/oauth2/v1/tokeninfo':
+            self.send_json(200, {'issued_to': CLIENT_ID,
+                                 'audience': CLIENT_ID,
+                                 'user_id': token[len(TOKEN_PREFIX):],
+                                 'expires_in': 3600})
+        elif url.path == '/oauth2/v1/userinfo':
+            user_id = token[len(TOKEN_PREFIX):]
+            self.send_json(200, {'id': user_id,
+                                 'name': 'Stub User %s' % user_id,
+                                 'email': '%s@example.com' % user_id})
+        elif url.path == '/o/oauth2/revoke':
+            self.send_json(200, {})
+        else:
+            self.send_json(404, {'error': 'not_found'})
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep benchmark output readable
+        pass
+
+
+def create_stub_server(port=0, latency=0):
+    """Create the stub server. Port 0 picks a free port, found afterwards in
+       server.server_address.
+    """
+
+    handler = type('Handler', (OAuthStubHandler,), {'latency': latency})
+    return ThreadingHTTPServer(('localhost', port), handler)
+
+
+#
+# MAIN FUNCTION
+#
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8001
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0
+
+    server = create_stub_server(port, latency)
+    print('OAuth stub server running in http://localhost:%s/' % port)
+    server.serve_forever()
@@ -0,0 +1,361 @@
+# PRERENDER.PY exports the pages of the Pokemon Types app as seen by visitors
+# who are not logged in, along with their JSON counterparts, as static files
+# that a plain file server or CDN can serve. The home page, every type page
+# and every details page are rendered by the app itself on a pool of worker
+# processes. The first run renders everything. Later runs only render the
+# pages affected by the changes in the change feed since the previous run.
+#
+# Usage: python prerender.py [output directory] [--full]
+# --full renders every page again, ex. after templates or static files change.
+
+import os
+import sys
+import json
+import time
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Output directory by default
+PRERENDER_DIR = os.environ.get('PRERENDER_DIR', 'prerendered')
+
+# Worker processes rendering pages, one per CPU by default
+PRERENDER_WORKERS = int(os.environ.get('PRERENDER_WORKERS', 0)) or \
+    os.cpu_count() or 1
+
+# File in the output directory remembering what the last run rendered
+MANIFEST_NAME = '.prerender.json'
+
+# Pokemon whose pages are rendered by each task given to a worker
+POKEMON_PER_TASK = 100
+
+# Test client of the app in each worker process
+client = None
+
+
+#
+# OUTPUT FILES
+#
+def get_output_path(output_dir, url):
+    """Return the file serving the URL. Pages are written as index.html in
+       the directory of their URL and JSON responses as a file named json.
+
+       Ex. /pokemon/ -> pokemon/index.html, /pokemon/1 ->
+       pokemon/1/index.html, /pokemon/1/json -> pokemon/1/json
+    """
+
+    parts = url.strip('/').split('/')
+    if parts[-1] != 'json':
+        parts.append('index.html')
+
+    return os.path.join(output_dir, *parts)
+
+
+def write_file(path, data):
+    """Replace the file atomically, so a file server never sends half of it"""
+
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    temporary_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(temporary_path, 'wb') as output_file:
+        output_file.write(data)
+    os.replace(temporary_path, path)
+
+
+def read_manifest(output_dir):
+    """Return the manifest of the last run or None if there was none"""
+
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (IOError, ValueError):
+        return None
+
+    # JSON object keys are strings
+    for name in ['similar', 'lowest']:
+        manifest[name] = dict((int(id), value) for id, value
+                              in manifest.get(name, {}).items())
+    return manifest
+
+
+def write_manifest(output_dir, cursor, similar, lowest):
+    """Remember the change feed cursor the pages are up to date with, the
+       similar pokemon shown on each details page and the lowest score among
+       them
+    """
+
+    data = json.dumps({'cursor': cursor, 'similar': similar,
+                       'lowest': lowest}, sort_keys=True).encode('utf-8')
+    write_file(os.path.join(output_dir, MANIFEST_NAME), data)
+
+
+def copy_static_files(app, output_dir):
+    """Copy the static files under the fingerprinted names pages link to"""
+
+    from fingerprint import get_fingerprints
+
+    for filename, fingerprinted in get_fingerprints(
+            app.static_folder).items():
+        path = os.path.join(output_dir, 'static', *fingerprinted.split('/'))
+        if not os.path.exists(path):
+            with open(os.path.join(app.static_folder, filename),
+                      'rb') as static_file:
+                write_file(path, static_file.read())
+
+
+#
+# RENDERING
+#
+def init_worker():
+    """Give the worker process its own database connections and test client.
+       With fork, the app imported by the parent process is reused.
+    """
+
+    global client
+
+    import pokemon_types
+    from database_setup import engine, read_engine
+
+    # Connections opened by the parent process must not be shared
+    engine.dispose(close=False)
+    read_engine.dispose(close=False)
+
+    # Every page is requested by this one client
+    pokemon_types.rate_limiter.enabled = False
+
+    # Pages flash messages, ex. when a type has no pokemon. Without cookies,
+    # each message only shows on the page that flashed it.
+    if not pokemon_types.app.secret_key:
+        pokemon_types.app.secret_key = 'prerender'
+    client = pokemon_types.app.test_client(use_cookies=False)
+
+
+def render_urls(output_dir, urls):
+    """Request the URLs as a visitor who is not logged in and write the
+       responses to their files
+    """
+
+    for url in urls:
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError('%s failed with status %s'
+                               % (url, response.status_code))
+        write_file(get_output_path(output_dir, url), response.get_data())
+
+
+def render_pokemon(output_dir, ids):
+    """Render the details pages and JSON of the pokemon
+
+       Return value: (dict): IDs of the similar pokemon shown on each page
+                     and the lowest score among them
+    """
+
+    import pokemon_types
+
+    urls = []
+    for id in ids:
+        urls.append('/pokemon/%s' % id)
+        urls.append('/pokemon/%s/json' % id)
+    render_urls(output_dir, urls)
+
+    similar = {}
+    for id in ids:
+        similar_list = pokemon_types.similar_pokemon.get_similar(
+            id, pokemon_types.session)
+        similar[id] = ([item['id'] for item in similar_list],
+                       similar_list[-1]['score'] if similar_list else 0)
+    pokemon_types.session.remove()
+
+    return similar
+
+
+def render_listings(output_dir, urls):
+    """Render the home and type pages and their JSON"""
+
+    import pokemon_types
+
+    render_urls(output_dir, urls)
+    pokemon_types.session.remove()
+
+    return {}
+
+
+def get_listing_urls(app, session):
+    """Return the URLs of the home page, the type pages and their JSON"""
+
+    from database_setup import Type
+
+    urls = []
+    with app.test_request_context():
+        from flask import url_for
+        urls.append(url_for('showHome'))
+        urls.append(url_for('showAllJson'))
+        for name, in session.query(Type.name).order_by(Type.name):
+            urls.append(url_for('showType', type=name))
+            urls.append(url_for('showTypeJson', type=name))
+
+    return urls
+
+
+def get_changed_pokemon(session, cursor):
+    """Return the IDs of the pokemon changed and deleted after the cursor.
+       A changed display row counts as a change of its pokemon, ex. when the
+       pokemon it evolves to was renamed.
+    """
+
+    from database_setup import ChangeLog
+
+    changed = set()
+    deleted = set()
+    for row_id, is_deleted in session.query(
+            ChangeLog.row_id, ChangeLog.is_deleted).filter(
+                ChangeLog.kind == 'pokemon', ChangeLog.seq > cursor):
+        if is_deleted:
+            deleted.add(row_id)
+        else:
+            changed.add(row_id)
+
+    return changed, deleted
+
+
+def get_newly_similar(index, session, ids, changed, similar, lowest):
+    """Return the pokemon not in ids whose similar pokemon now differ from
+       those on their pages, since a changed pokemon became one of them.
+       Scores are symmetric, so the scores of each changed pokemon tell the
+       pokemon it may have entered the list of. Their lists are ranked again
+       and compared with the manifest.
+
+       Args: index (SimilarityIndex): Loaded with the current catalog
+             similar (dict): IDs of the similar pokemon on each page
+             lowest (dict): Lowest score shown on each page
+    """
+
+    from bitsets import MAX_SIMILAR
+
+    candidates = set()
+    for changed_id in changed:
+        for id, score in index.get_scores(changed_id, session).items():
+            if id in ids or id in candidates or score <= 0:
+                continue
+            if id not in lowest:
+                candidates.add(id)
+            elif len(similar.get(id, [])) < MAX_SIMILAR:
+                candidates.add(id)
+            # Shown scores are rounded to 4 decimals
+            elif score >= lowest[id] - 0.0001:
+                candidates.add(id)
+
+    return set(id for id in candidates
+               if [item['id'] for item in index.get_similar(id, session)] !=
+               similar.get(id))
+
+
+def prerender(output_dir=PRERENDER_DIR, full=False,
+              workers=PRERENDER_WORKERS):
+    """Render the pages changed since the last run, or all pages if full or
+       on the first run
+
+       Return value: (int): Number of files written
+    """
+
+    import pokemon_types
+    from sqlalchemy import func
+    from database_setup import Pokemon, ChangeLog, engine, read_engine
+
+    session = pokemon_types.session
+
+    # Changes logged after this are rendered by the next run
+    cursor = session.query(func.max(ChangeLog.seq)).scalar() or 0
+    all_ids = set(id for id, in session.query(Pokemon.id))
+
+    # Forked worker processes start with the bitsets of the similar pokemon
+    # already loaded
+    pokemon_types.similar_pokemon.load(session)
+
+    manifest = None if full else read_manifest(output_dir)
+    if manifest is None:
+        ids = all_ids
+        deleted = set()
+        similar = {}
+        lowest = {}
+    else:
+        if manifest['cursor'] == cursor:
+            print('Pages are up to date.')
+            return 0
+
+        changed, deleted = get_changed_pokemon(session, manifest['cursor'])
+        deleted.difference_update(all_ids)
+        similar = manifest['similar']
+        lowest = manifest['lowest']
+
+        # Pages showing a changed pokemon among the similar pokemon too
+        ids = set(changed)
+        for id, similar_ids in similar.items():
+            if changed.intersection(similar_ids) or \
+                    deleted.intersection(similar_ids):
+                ids.add(id)
+        ids.intersection_update(all_ids)
+
+        # Pages a changed pokemon now belongs on
+        ids.update(get_newly_similar(
+            pokemon_types.similar_pokemon, session, ids,
+            changed.intersection(all_ids), similar, lowest))
+
+    for id in deleted:
+        similar.pop(id, None)
+        lowest.pop(id, None)
+        shutil.rmtree(os.path.join(output_dir, 'pokemon', str(id)),
+                      ignore_errors=True)
+
+    copy_static_files(pokemon_types.app, output_dir)
+
+    ids = sorted(ids)
+    tasks = [(render_listings, get_listing_urls(pokemon_types.app, session))]
+    for start in range(0, len(ids), POKEMON_PER_TASK):
+        tasks.append((render_pokemon, ids[start:start + POKEMON_PER_TASK]))
+
+    # Worker processes open their own connections
+    session.remove()
+    engine.dispose()
+    read_engine.dispose()
+
+    if workers <= 1 or len(tasks) == 1:
+        init_worker()
+        results = [task(output_dir, items) for task, items in tasks]
+    else:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        with ProcessPoolExecutor(min(workers, len(tasks)),
+                                 mp_context=context,
+                                 initializer=init_worker) as executor:
+            futures = [executor.submit(task, output_dir, items)
+                       for task, items in tasks]
+            results = [future.result() for future in futures]
+
+    for result in results:
+        for id, (similar_ids, lowest_score) in result.items():
+            similar[id] = similar_ids
+            lowest[id] = lowest_score
+    write_manifest(output_dir, cursor, similar, lowest)
+
+    return len(tasks[0][1]) + 2 * len(ids)
+
+
+#
+# MAIN FUNCTION
+#
+if __name__ == '__main__':
+    arguments = [argument for argument in sys.argv[1:]
+                 if argument != '--full']
+    output_dir = arguments[0] if arguments else PRERENDER_DIR
+
+    start = time.perf_counter()
+    count = prerender(output_dir, full='--full' in sys.argv)
+    if count:
+        print('Wrote %s files to %s in %.1f s' % (
+            count, output_dir, time.perf_counter() - start))
@@ -0,0 +1,258 @@
+# PROFILER.PY is a sampling profiler that can be turned on for live routes of
+# the Pokemon Types app without redeploying. While it is on, a background
+# thread looks at the stacks of the threads handling profiled requests every
+# few milliseconds and counts them. The counts are given as collapsed stacks,
+# the input of flamegraph tools, and as a summary of the top functions.
+# Requests are not slowed down while it is off.
+
+import os
+import sys
+import time
+import threading
+from flask import request, g
+
+
+# Emails of the users allowed to use the profiler, comma-separated
+ADMIN_EMAILS = set(email.strip().lower() for email in
+                   os.environ.get('ADMIN_EMAILS', '').split(',')
+                   if email.strip())
+
+# Milliseconds between samples by default and at least
+DEFAULT_INTERVAL = 5
+MIN_INTERVAL = 1
+
+# Functions listed in the top functions summary by default
+TOP_FUNCTIONS = 25
+
+
+def is_admin(email):
+    """Return whether the user with the email may use the profiler"""
+
+    return bool(email) and email.lower() in ADMIN_EMAILS
+
+
+def not_profiled(view):
+    """Decorator for views never profiled, ex. the profiler's own views"""
+
+    view.not_profiled = True
+    return view
+
+
+def get_frame_name(frame):
+    """Name a stack frame by its function and the file defining it
+
+       Return value: (str): Ex. 'view_model.py:Pokemon_VM.__init__'
+    """
+
+    code = frame.f_code
+    name = getattr(code, 'co_qualname', code.co_name)
+
+    return '%s:%s' % (os.path.basename(code.co_filename),
+                      name.replace(';', ':'))
+
+
+class SamplingProfiler():
+    """Counts the stacks of the threads handling profiled requests. Stacks
+       start with the endpoint of the request, so samples of different
+       routes are kept apart.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.armed = False
+        self.endpoint = None
+        self.remaining = None
+        self.interval = DEFAULT_INTERVAL / 1000.0
+        # Thread ident: endpoint, of the requests being profiled
+        self.threads = {}
+        self.sampler = None
+        self.reset()
+
+    def reset(self):
+        """Forget the samples taken so far"""
+
+        with self.lock:
+            # Collapsed stack: number of samples
+            self.stacks = {}
+            self.samples = 0
+            self.requests = 0
+            self.started = None
+
+    def start(self, endpoint=None, requests=None, interval=DEFAULT_INTERVAL):
+        """Profile the next requests, forgetting earlier samples
+
+           Args: endpoint (str): Only profile requests of this view, ex.
+                     'showType'. None for all views.
+                 requests (int): Stop after this many requests. None to
+                     profile until stopped.
+                 interval (int): Milliseconds between samples
+        """
+
+        self.reset()
+        with self.lock:
+            self.armed = True
+            self.endpoint = endpoint
+            self.remaining = requests
+            self.interval = max(interval, MIN_INTERVAL) / 1000.0
+            self.started = time.time()
+
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self.sample_loop,
+                                                name='profiler',
+                                                daemon=True)
+                self.sampler.start()
+
+    def stop(self):
+        """Stop profiling new requests. Samples are kept for download."""
+
+        with self.lock:
+            self.armed = False
+
+    def begin_request(self, endpoint):
+        """Start profiling the request handled by the current thread if the
+           profiler is on for its endpoint
+        """
+
+        # Checked without the lock first so requests are not slowed down
+        # while the profiler is off
+        if not self.armed:
+            return
+
+        with self.lock:
+            if not self.armed:
+                return
+            if self.endpoint is not None and endpoint != self.endpoint:
+                return
+
+            self.threads[threading.get_ident()] = endpoint
+            self.requests += 1
+            if self.remaining is not None:
+                self.remaining -= 1
+                if self.remaining <= 0:
+                    self.armed = False
+
+    def end_request(self):
+        """Stop profiling the request handled by the current thread"""
+
+        if self.threads:
+            with self.lock:
+                self.threads.pop(threading.get_ident(), None)
+
+    def sample_loop(self):
+        """Sample the profiled threads until the profiler is off and their
+           requests have finished
+        """
+
+        while True:
+            time.sleep(self.interval)
+
+            with self.lock:
+                if not self.armed and not self.threads:
+                    self.sampler = None
+                    return
+                threads = list(self.threads.items())
+
+            frames = sys._current_frames()
+            stacks = []
+            for ident, endpoint in threads:
+                frame = frames.get(ident)
+                names = []
+                while frame is not None:
+                    names.append(get_frame_name(frame))
+                    frame = frame.f_back
+                names.append(endpoint)
+                stacks.append(';'.join(reversed(names)))
+            del frames
+
+            with self.lock:
+                for stack in stacks:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                    self.samples += 1
+
+    def get_status(self):
+        """Return the settings of the profiler and the number of samples"""
+
+        with self.lock:
+            return {
+                'armed': self.armed,
+                'endpoint': self.endpoint,
+                'remaining_requests': self.remaining,
+                'interval': round(self.interval * 1000),
+                'requests': self.requests,
+                'samples': self.samples,
+                'started': self.started
+                }
+
+    def get_collapsed(self):
+        """Return the samples as collapsed stacks, one per line with its
+           number of samples, most sampled first
+
+           Return value: (str): Ex. 'showType;app.py:Flask.wsgi_app;... 12\n'
+        """
+
+        with self.lock:
+            stacks = sorted(self.stacks.items(), key=lambda item: -item[1])
+
+        return ''.join('%s %d\n' % (stack, count) for stack, count in stacks)
+
+    def get_top_functions(self, limit=TOP_FUNCTIONS):
+        """Return the functions found in the most samples. self counts the
+           samples running the function itself, total those running it or a
+           function it called.
+
+           Return value: (list): Ex. [{'function': 'view_model.py:...',
+                         'self': 40, 'total': 52, 'self_percent': 20.0,
+                         'total_percent': 26.0}]
+        """
+
+        with self.lock:
+            stacks = list(self.stacks.items())
+            samples = self.samples
+
+        self_counts = {}
+        total_counts = {}
+        for stack, count in stacks:
+            # The first name is the endpoint, not a function
+            names = stack.split(';')[1:]
+            if not names:
+                continue
+            self_counts[names[-1]] = self_counts.get(names[-1], 0) + count
+            for name in set(names):
+                total_counts[name] = total_counts.get(name, 0) + count
+
+        top = sorted(total_counts, key=lambda name: (
+            -self_counts.get(name, 0), -total_counts[name], name))[:limit]
+
+        def percent(count):
+            return round(100.0 * count / samples, 1) if samples else 0.0
+
+        return [{'function': name,
+                 'self': self_counts.get(name, 0),
+                 'total': total_counts[name],
+                 'self_percent': percent(self_counts.get(name, 0)),
+                 'total_percent': percent(total_counts[name])}
+                for name in top]
+
+
+def init_profiler(app, profiler):
+    """Let the profiler follow the requests of the app"""
+
+    @app.before_request
+    def begin_profiled_request():
+        view = app.view_functions.get(request.endpoint)
+        if view is not None and not getattr(view, 'not_profiled', False):
+            profiler.begin_request(request.endpoint)
+
+    @app.after_request
+    def end_streamed_request(response):
+        # Streamed pages are rendered while they are sent, after the request
+        # has been torn down, so they are profiled until they are sent
+        if g.get('streaming'):
+            g.profiled_until_sent = True
+            response.call_on_close(profiler.end_request)
+        return response
+
+    @app.teardown_request
+    def end_profiled_request(exception):
+        if not g.get('profiled_until_sent'):
+            profiler.end_request()
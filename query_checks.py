@@ -0,0 +1,347 @@
+# QUERY_CHECKS.PY checks that the database queries of the Pokemon Types app
+# stay cheap as the catalog grows: filtered listings must use indexes, and the
+# number of SQL statements of each route must stay within a budget that does
+# not depend on the number of pokemon. The checks run against a scratch SQLite
+# database seeded with generated pokemon. Set DATABASE_URL to run them against
+# a scratch PostgreSQL database instead. Generated rows are added to it.
+#
+# Usage: python query_checks.py
+# Exits with status 1 when any check fails.
+
+import os
+import sys
+import random
+import tempfile
+import threading
+
+# The database must be chosen before database_setup creates the engine
+if 'DATABASE_URL' not in os.environ:
+    scratch_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    os.environ['DATABASE_URL'] = 'sqlite:///' + scratch_file.name
+
+# The app must not replace the catalog snapshot of the real database
+snapshot_path = os.path.join(tempfile.gettempdir(),
+                             'query_checks.%s.snapshot' % os.getpid())
+os.environ['CATALOG_SNAPSHOT'] = snapshot_path
+
+from sqlalchemy import text, event
+from sqlalchemy.orm import sessionmaker
+from database_setup import (
+    engine,
+    read_engine,
+    Pokemon,
+    User,
+    Category,
+    Type,
+    Move
+    )
+from view_model import (
+    parse_pokemon_filters,
+    filter_pokemon,
+    sort_pokemon,
+    rebuild_pokemon_displays
+    )
+
+
+TYPE_NAMES = ['Bug', 'Dark', 'Ground', 'Dragon', 'Ice', 'Electric', 'Normal',
+              'Fairy', 'Fighting', 'Psychic', 'Rock', 'Flying', 'Steel',
+              'Ghost', 'Fire', 'Grass', 'Poison', 'Water']
+
+
+#
+# DATASET
+#
+def seed_catalog(session, count, seed=0):
+    """Add generated types, moves, categories and count pokemon with their
+       display rows. The same seed always generates the same catalog.
+    """
+
+    generator = random.Random(seed)
+
+    user = User(name='Checker', email='checker@example.com')
+    session.add(user)
+
+    if session.query(Type).count() == 0:
+        for name in TYPE_NAMES:
+            session.add(Type(name=name))
+    categories = [Category(name='Category %s' % number)
+                  for number in range(10)]
+    moves = [Move(name='Move %s' % number) for number in range(200)]
+    session.add_all(categories + moves)
+    session.flush()
+
+    type_ids = [type.id for type in session.query(Type)]
+    move_ids = [move.id for move in moves]
+
+    start = (session.query(Pokemon).count() or 0) + 1
+    for number in range(start, start + count):
+        session.add(Pokemon(
+            pokedex_id=number,
+            name='Pokemon %s' % number,
+            description='Generated pokemon %s' % number,
+            image='https://example.com/%s.png' % number,
+            height=generator.randint(8, 200),
+            weight=round(generator.uniform(1, 900), 1),
+            is_mythical=generator.random() < 0.02,
+            is_legendary=generator.random() < 0.05,
+            evolution_before=number - 1 if number % 3 else None,
+            evolution_after_list=[number + 1] if number % 3 != 2 else [],
+            type_list=generator.sample(type_ids, generator.randint(1, 2)),
+            weakness_list=generator.sample(type_ids, 4),
+            move_list=generator.sample(move_ids, 12),
+            category_id=generator.choice(categories).id,
+            user_id=user.id))
+
+    session.flush()
+    rebuild_pokemon_displays(session)
+    session.commit()
+
+    return user
+
+
+#
+# QUERY PLAN CHECKS
+#
+
+# Listing filters that must be served from an index rather than by reading
+# the whole pokemon table, given as request parameters. The list filters
+# can only use an index on PostgreSQL. A wide one-sided range alone may
+# rightly be read in Pokedex order instead, to avoid sorting.
+PLAN_CHECKS = [
+    ({'legendary': 'true', 'min_weight': '220'}, ['postgresql', 'sqlite']),
+    ({'legendary': 'true', 'min_weight': '220', 'sort': 'height'},
+     ['postgresql', 'sqlite']),
+    ({'mythical': 'true', 'max_height': '40'}, ['postgresql', 'sqlite']),
+    ({'min_weight': '800', 'max_weight': '810'}, ['postgresql', 'sqlite']),
+    ({'min_height': '60', 'max_height': '62'}, ['postgresql', 'sqlite']),
+    ({'category': 'Category 3'}, ['postgresql', 'sqlite']),
+    ({'type': 'Dragon'}, ['postgresql']),
+    ({'move': 'Move 7'}, ['postgresql'])
+    ]
+
+
+def explain(session, query):
+    """Return the lines of the query plan chosen by the database"""
+
+    statement = str(query.statement.compile(
+        engine, compile_kwargs={'literal_binds': True}))
+
+    if engine.dialect.name == 'postgresql':
+        # Show an index scan whenever one is possible, even on small tables
+        session.execute(text('SET enable_seqscan = off'))
+        rows = session.execute(text('EXPLAIN ' + statement))
+        return [row[0] for row in rows]
+
+    rows = session.execute(text('EXPLAIN QUERY PLAN ' + statement))
+    return [row[-1] for row in rows]
+
+
+def is_index_search(plan):
+    """Check if the plan finds the pokemon rows with an index condition
+       rather than reading the whole table or a whole index
+    """
+
+    for line in plan:
+        # SQLite
+        if line.startswith('SEARCH pokemon'):
+            return True
+        # PostgreSQL
+        if 'Index Cond' in line or 'Recheck Cond' in line:
+            return True
+
+    return False
+
+
+def check_query_plans(session):
+    """Filtered pokemon listings must not read the whole pokemon table"""
+
+    failures = []
+
+    for args, dialects in PLAN_CHECKS:
+        if engine.dialect.name not in dialects:
+            continue
+
+        filters = parse_pokemon_filters(args)
+        query = sort_pokemon(
+            filter_pokemon(session.query(Pokemon.id), filters, session),
+            filters)
+        plan = explain(session, query)
+
+        if not is_index_search(plan):
+            failures.append('Full scan for %s:\n    %s'
+                            % (args, '\n    '.join(plan)))
+
+    session.rollback()
+    return failures
+
+
+#
+# QUERY BUDGET CHECKS
+#
+
+# Most SQL statements each route may run, whatever the number of pokemon.
+# {id} is a pokemon added by the logged-in user, with evolutions. Statement
+# counts of a route growing with the catalog point to a lookup per row.
+# JSON requests without parameters are served from the catalog snapshot, so
+# they are also checked with a parameter to count their database queries.
+QUERY_BUDGETS = [
+    ('GET', '/pokemon/', 6),
+    ('GET', '/pokemon/dragon', 7),
+    ('GET', '/pokemon/{id}', 4),
+    ('GET', '/pokemon/{id}/similar/json', 2),
+    ('GET', '/pokemon/team/optimize?require={id}&exclude_types=ice', 3),
+    ('GET', '/pokemon/{id}/edit', 6),
+    ('GET', '/pokemon/json', 0),
+    ('GET', '/pokemon/json?sort=pokedex_id', 1),
+    ('GET', '/pokemon/dragon/json', 0),
+    ('GET', '/pokemon/dragon/json?sort=pokedex_id', 2),
+    ('GET', '/pokemon/{id}/json', 0),
+    ('GET', '/pokemon/{id}/json?fields=name', 1),
+    ('GET', '/pokemon/facets/json', 3),
+    ('GET', '/pokemon/type/json', 1),
+    ('GET', '/pokemon/category/json', 1),
+    ('GET', '/pokemon/move/json', 1),
+    ('GET', '/pokemon/changes', 4),
+    ('GET', '/pokemon/autocomplete/move?prefix=move', 3),
+    ('GET', '/pokemon/cleanup', 4),
+    ('POST', '/pokemon/cleanup', 2)
+    ]
+
+# Pokemon added to the catalog before counting statements again
+BUDGET_GROWTH = 2000
+
+
+class StatementCounter(object):
+    """Counts the SQL statements sent to the database by requests while in
+       use, on the request thread and the writer thread. Statements of
+       background jobs are not counted.
+
+       Ex. with StatementCounter() as counter: ...
+           counter.count
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.engines = [engine]
+        if read_engine is not engine:
+            self.engines.append(read_engine)
+
+    def __enter__(self):
+        for counted_engine in self.engines:
+            event.listen(counted_engine, 'before_cursor_execute',
+                         self.count_statement)
+        return self
+
+    def __exit__(self, *exc_info):
+        for counted_engine in self.engines:
+            event.remove(counted_engine, 'before_cursor_execute',
+                         self.count_statement)
+
+    def count_statement(self, *args):
+        if not threading.current_thread().name.startswith('job'):
+            self.count += 1
+
+
+def count_route_statements(pokemon_id, user):
+    """Request each route of QUERY_BUDGETS as the user and return the number
+       of SQL statements of each. Caches are cleared before each request so
+       the full cost is counted.
+    """
+
+    # The app is imported here so it finds the seeded catalog
+    import pokemon_types
+
+    pokemon_types.app.secret_key = 'query_checks'
+    client = pokemon_types.app.test_client()
+    with client.session_transaction() as login_session:
+        login_session['email'] = user.email
+        login_session['username'] = user.name
+        login_session['user_id'] = user.id
+
+    counts = []
+    for method, path, _ in QUERY_BUDGETS:
+        pokemon_types.session.close()
+        pokemon_types.catalog_changed()
+        pokemon_types.autocomplete_indexes.clear()
+        pokemon_types.pokemon_details.clear()
+
+        with StatementCounter() as counter:
+            response = client.open(path.format(id=pokemon_id), method=method,
+                                   buffered=True)
+        pokemon_types.job_runner.wait()
+
+        if response.status_code >= 400:
+            raise RuntimeError('%s %s failed with status %s'
+                               % (method, path, response.status_code))
+        counts.append(counter.count)
+
+    pokemon_types.session.close()
+    return counts
+
+
+def check_query_budgets(session):
+    """Routes stay within their SQL statement budgets as pokemon are added"""
+
+    pokemon = session.query(Pokemon).filter(
+        Pokemon.evolution_before.isnot(None)).order_by(Pokemon.id).first()
+    user = session.query(User).filter_by(id=pokemon.user_id).one()
+
+    counts = count_route_statements(pokemon.id, user)
+    seed_catalog(session, BUDGET_GROWTH, seed=1)
+    grown_counts = count_route_statements(pokemon.id, user)
+
+    failures = []
+    for (method, path, budget), count, grown_count in zip(
+            QUERY_BUDGETS, counts, grown_counts):
+        if max(count, grown_count) > budget:
+            failures.append('%s %s ran %s statements, budget is %s'
+                            % (method, path, max(count, grown_count), budget))
+        elif count != grown_count:
+            failures.append('%s %s ran %s statements, then %s after adding '
+                            '%s pokemon' % (method, path, count, grown_count,
+                                            BUDGET_GROWTH))
+
+    return failures
+
+
+# Checks adding to the catalog come last
+CHECKS = [
+    check_query_plans,
+    check_query_budgets
+    ]
+
+
+#
+# MAIN FUNCTION
+#
+if __name__ == '__main__':
+    DBSession = sessionmaker(bind=engine)
+    session = DBSession()
+
+    seed_catalog(session, 2000)
+    if engine.dialect.name == 'postgresql':
+        # The app leaves SQLite without statistics, so only analyze here
+        session.execute(text('ANALYZE'))
+        session.commit()
+
+    failed = False
+    for check in CHECKS:
+        failures = check(session)
+        if failures:
+            failed = True
+            print('FAIL %s' % check.__doc__)
+            for failure in failures:
+                print('  ' + failure)
+        else:
+            print('ok   %s' % check.__doc__)
+
+    session.close()
+    if 'scratch_file' in globals():
+        # WAL mode leaves the write-ahead log and shared memory files too
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(scratch_file.name + suffix):
+                os.remove(scratch_file.name + suffix)
+    if os.path.exists(snapshot_path):
+        os.remove(snapshot_path)
+
+    sys.exit(1 if failed else 0)
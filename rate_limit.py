@@ -0,0 +1,303 @@
+# RATE_LIMIT.PY keeps single clients of the JSON API of the Pokemon Types app
+# from starving everyone else. Each client, by API key or else by address,
+# has a token bucket refilled at RATE_LIMIT requests per second that holds at
+# most RATE_LIMIT_BURST requests. Requests finding their bucket empty get a
+# 429 response with Retry-After. Endpoints costly to serve also have a limit
+# on the requests they handle at the same time per process, beyond which
+# requests are turned away at once instead of queueing.
+# Buckets are kept in memory by default, so each worker process has its own.
+# RATE_LIMIT_DATABASE names a SQLite file to share them between the worker
+# processes of a host.
+
+import os
+import json
+import math
+import time
+import sqlite3
+import threading
+from functools import wraps
+from collections import OrderedDict
+from flask import request, make_response, current_app
+
+
+# Requests per second a client may make on average. 0 turns limiting off.
+RATE_LIMIT = float(os.environ.get('RATE_LIMIT', 10))
+
+# Requests a client may make at once after being idle
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', 30))
+
+# SQLite file shared by the worker processes, or None to keep the buckets in
+# memory
+RATE_LIMIT_DATABASE = os.environ.get('RATE_LIMIT_DATABASE')
+
+# Keys of the clients limited by key rather than by address, comma-separated.
+# Other keys are ignored, so clients cannot get new buckets by making them up.
+API_KEYS = set(key.strip() for key in
+               os.environ.get('API_KEYS', '').split(',') if key.strip())
+
+# Header of the API key
+API_KEY_HEADER = 'X-API-Key'
+
+# Full-catalog requests each worker process handles at the same time
+MAX_CATALOG_REQUESTS = int(os.environ.get('MAX_CATALOG_REQUESTS', 4))
+
+# Seconds clients turned away by a concurrency limit are asked to wait
+SHED_RETRY_AFTER = 1
+
+# Most buckets kept in memory. The least recently used are dropped first,
+# which only gives their clients a full bucket again.
+MAX_BUCKETS = 10000
+
+# Seconds between removals of full buckets from the SQLite file
+PRUNE_INTERVAL = 60
+
+
+def take_token(tokens, updated, now, rate, burst):
+    """Refill the bucket for the time since it was updated and take a token
+
+       Args: tokens (float): Tokens in the bucket when it was updated
+             updated (float): Time of the update in seconds
+       Return value: (tuple): Tokens left and seconds to wait for a token,
+                     0 if one was taken
+    """
+
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+
+    return tokens, (1 - tokens) / rate
+
+
+#
+# BUCKETS
+#
+class MemoryBuckets():
+    """Token buckets of the clients kept in memory"""
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self.lock = threading.Lock()
+        # Client: (tokens, time updated)
+        self.buckets = OrderedDict()
+
+    def take(self, client, now, rate, burst):
+        """Take a token from the bucket of the client
+
+           Return value: (float): Seconds to wait for a token, 0 if one was
+                         taken
+        """
+
+        with self.lock:
+            tokens, updated = self.buckets.pop(client, (burst, now))
+            tokens, wait = take_token(tokens, updated, now, rate, burst)
+            self.buckets[client] = (tokens, now)
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+
+        return wait
+
+    def clear(self):
+        """Give every client a full bucket again"""
+
+        with self.lock:
+            self.buckets.clear()
+
+
+class SQLiteBuckets():
+    """Token buckets of the clients kept in a SQLite file, so the worker
+       processes of a host share them. Each take is a short transaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.pruned = 0
+
+    def get_connection(self):
+        """Return the connection of the current thread, opening it first"""
+
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # Transactions are begun explicitly
+            connection = sqlite3.connect(self.path, timeout=5,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            # Losing the latest takes in a crash only refills some buckets
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS bucket (client TEXT PRIMARY KEY, '
+                'tokens REAL NOT NULL, updated REAL NOT NULL) WITHOUT ROWID')
+            self.local.connection = connection
+
+        return connection
+
+    def take(self, client, now, rate, burst):
+        """Take a token from the bucket of the client
+
+           Return value: (float): Seconds to wait for a token, 0 if one was
+                         taken
+        """
+
+        connection = self.get_connection()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError:
+            # Requests go ahead rather than fail while the file stays locked
+            return 0.0
+
+        try:
+            row = connection.execute(
+                'SELECT tokens, updated FROM bucket WHERE client = ?',
+                (client,)).fetchone()
+            tokens, updated = row or (burst, now)
+            tokens, wait = take_token(tokens, updated, now, rate, burst)
+            connection.execute(
+                'INSERT OR REPLACE INTO bucket (client, tokens, updated) '
+                'VALUES (?, ?, ?)', (client, tokens, now))
+
+            if now - self.pruned > PRUNE_INTERVAL:
+                # Buckets idle long enough to be full again
+                self.pruned = now
+                connection.execute('DELETE FROM bucket WHERE updated < ?',
+                                   (now - burst / rate,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        return wait
+
+    def clear(self):
+        """Give every client a full bucket again"""
+
+        self.get_connection().execute('DELETE FROM bucket')
+
+
+#
+# LIMITS
+#
+class RateLimiter():
+    """Token bucket rate limit of each client of the views marked with
+       rate_limited
+    """
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_LIMIT_BURST,
+                 path=RATE_LIMIT_DATABASE):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.enabled = rate > 0
+        if path:
+            self.buckets = SQLiteBuckets(path)
+        else:
+            self.buckets = MemoryBuckets()
+
+    def check(self, client):
+        """Take a token from the bucket of the client
+
+           Return value: (float): Seconds the client must wait before its
+                         next request, 0 if the request may go ahead
+        """
+
+        if not self.enabled:
+            return 0.0
+
+        return self.buckets.take(client, time.time(), self.rate, self.burst)
+
+
+class ConcurrencyLimit():
+    """Limit on the requests handled at the same time by the views it
+       decorates. A request keeps its slot until its response is closed, so
+       streamed and snapshot bodies count until they are sent.
+    """
+
+    def __init__(self, max_requests=MAX_CATALOG_REQUESTS):
+        self.semaphore = threading.BoundedSemaphore(max_requests)
+
+    def __call__(self, applies=None):
+        """Decorator for views limited. Requests over the limit get a 429
+           response.
+
+           Args: applies (function): Given the arguments of the view, returns
+                 whether the request counts toward the limit. All requests
+                 count when None.
+        """
+
+        def decorator(view):
+            @wraps(view)
+            def limited_view(*args, **kwargs):
+                if applies is not None and not applies(*args, **kwargs):
+                    return view(*args, **kwargs)
+
+                if not self.semaphore.acquire(blocking=False):
+                    return too_many_requests(SHED_RETRY_AFTER)
+                try:
+                    response = current_app.make_response(
+                        view(*args, **kwargs))
+                except BaseException:
+                    self.semaphore.release()
+                    raise
+
+                # Close may be called more than once
+                released = []
+
+                def release():
+                    if not released:
+                        released.append(True)
+                        self.semaphore.release()
+
+                response.call_on_close(release)
+                return response
+
+            return limited_view
+
+        return decorator
+
+
+def rate_limited(view):
+    """Decorator for views limited by the rate limiter of init_rate_limits"""
+
+    view.rate_limited = True
+    return view
+
+
+def get_client():
+    """Name the client of the request by its API key if it is one of
+       API_KEYS, else by its address
+    """
+
+    key = request.headers.get(API_KEY_HEADER)
+    if key and key in API_KEYS:
+        return 'key:%s' % key
+
+    return 'address:%s' % request.remote_addr
+
+
+def too_many_requests(retry_after):
+    """Return the 429 response asking the client to wait retry_after
+       seconds
+    """
+
+    seconds = max(1, int(math.ceil(retry_after)))
+    response = make_response(json.dumps(
+        'Too many requests. Try again in %s seconds.' % seconds), 429)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Retry-After'] = str(seconds)
+    return response
+
+
+def init_rate_limits(app, rate_limiter):
+    """Apply the rate limiter to the views of the app marked with
+       rate_limited
+    """
+
+    @app.before_request
+    def limit_request_rate():
+        view = app.view_functions.get(request.endpoint)
+        if view is None or not getattr(view, 'rate_limited', False):
+            return None
+
+        retry_after = rate_limiter.check(get_client())
+        if retry_after:
+            return too_many_requests(retry_after)
+
+        return None
@@ -0,0 +1,107 @@
+# RENDERING.PY sets up the page templates of the Pokemon Types app and
+# streams large pages. Templates are compiled once at startup and their
+# compiled code is kept in a bytecode cache shared by all worker processes.
+# Listing pages are sent while they are rendered: the header and sidebar
+# first, then the tiles in chunks as the rows are read from the database.
+
+import os
+import itertools
+from jinja2 import FileSystemBytecodeCache
+from flask import current_app, stream_template
+
+
+# Directory of the bytecode cache. The default is a directory of the user in
+# the system temporary directory.
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR')
+
+# Rows read from the database and tiles sent at a time
+TILE_CHUNK_SIZE = 100
+
+# Most characters of a page kept before sending them
+MAX_BUFFER_SIZE = 16 * 1024
+
+
+def init_templates(app):
+    """Cache the compiled templates of the app and compile them all now,
+       so no request waits for a template to be compiled
+    """
+
+    if TEMPLATE_CACHE_DIR:
+        if not os.path.isdir(TEMPLATE_CACHE_DIR):
+            os.makedirs(TEMPLATE_CACHE_DIR)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            TEMPLATE_CACHE_DIR)
+    else:
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+
+def peek_rows(rows):
+    """Read the first row to know if there are any, without reading the
+       others
+
+       Return value: (tuple): (whether there are rows, iterator of all rows)
+    """
+
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return False, iter(())
+
+    return True, itertools.chain([first], rows)
+
+
+class StreamedRows():
+    """Rows looped over by a streamed template. Every chunk_size rows, the
+       page rendered so far is sent, so the browser shows the first tiles
+       while the next rows are read.
+    """
+
+    def __init__(self, rows, chunk_size=TILE_CHUNK_SIZE):
+        self.rows = rows
+        self.chunk_size = chunk_size
+        self.flush = False
+
+    def __iter__(self):
+        for number, row in enumerate(self.rows):
+            if number % self.chunk_size == 0:
+                self.flush = True
+            yield row
+
+
+def stream_page(template_name, rows_name, rows, on_close=None, **context):
+    """Stream the template rendered with the rows as the variable rows_name.
+       Flashed messages must be read before the page is streamed, since the
+       session cookie is sent before the page. on_close is called once the
+       page has been sent, ex. to release the database session the rows are
+       read with.
+
+       Return value: (Response): Streamed text/html response
+    """
+
+    streamed_rows = StreamedRows(rows)
+    context[rows_name] = streamed_rows
+    pieces = stream_template(template_name, **context)
+
+    def generate():
+        buffer = []
+        size = 0
+        for piece in pieces:
+            buffer.append(piece)
+            size += len(piece)
+            if streamed_rows.flush or size >= MAX_BUFFER_SIZE:
+                streamed_rows.flush = False
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+
+        if buffer:
+            yield ''.join(buffer)
+
+    response = current_app.response_class(generate(), mimetype='text/html')
+    if on_close is not None:
+        response.call_on_close(on_close)
+
+    return response
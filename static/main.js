@@ -7,4 +7,27 @@ $(function () {
 // Redirect to the page of the pokemon type selected from the dropdown
 $('.types-dropdown').change(function () {
     window.location.href = '/pokemon/' + $(this).val();
-});
\ No newline at end of file
+});
+// Suggest names for the last of the comma-separated values typed in the
+// inputs of the pokemon forms. Each suggestion keeps the values typed before
+$('input[data-autocomplete]').on('input', function () {
+    var input = $(this);
+    var suggestions = $('#' + input.attr('list'));
+    var values = input.val().split(',');
+    var prefix = values.pop().trim();
+
+    if (prefix === '') {
+        suggestions.empty();
+        return;
+    }
+
+    var typed = values.map(value => value.trim()).filter(value => value);
+    var url = '/pokemon/autocomplete/' + input.data('autocomplete');
+    $.getJSON(url, { prefix: prefix }, function (data) {
+        suggestions.empty();
+        data.Suggestions.forEach(function (name) {
+            suggestions.append($('<option>').attr(
+                'value', typed.concat([name]).join(', ')));
+        });
+    });
+});
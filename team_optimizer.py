@@ -0,0 +1,293 @@
+# TEAM_OPTIMIZER.PY builds teams of pokemon for the Pokemon Types app that
+# cover many types while sharing few weaknesses. Teams are built greedily and
+# then improved by swapping members, within a time budget.
+
+import time
+import threading
+from database_setup import Pokemon
+from bitsets import make_bitset
+
+
+DEFAULT_TEAM_SIZE = 6
+MAX_TEAM_SIZE = 10
+
+# Milliseconds the search may take by default and at most
+DEFAULT_TIME_BUDGET = 100
+MAX_TIME_BUDGET = 1000
+
+# Candidates checked between looks at the clock
+CHECK_TIME_EVERY = 256
+
+# Score of a team: each type covered counts for COVERAGE_WEIGHT and each
+# weakness shared by a pair of members against SHARED_WEAKNESS_WEIGHT
+COVERAGE_WEIGHT = 1.0
+SHARED_WEAKNESS_WEIGHT = 1.0
+
+
+class TeamError(Exception):
+    """Constraints that no team can meet"""
+
+
+class Candidate():
+    """Pokemon with the same types and weaknesses. They are interchangeable
+       in a team, so each combination is searched only once.
+    """
+
+    def __init__(self, type_bitset, weakness_bitset):
+        self.type_bitset = type_bitset
+        self.weakness_bitset = weakness_bitset
+        self.ids = []
+        # Number of members of the team from this group
+        self.used = 0
+
+
+def get_coverage(team):
+    """Return the number of types of the team members"""
+
+    type_bitset = 0
+    for candidate in team:
+        type_bitset |= candidate.type_bitset
+
+    return type_bitset.bit_count()
+
+
+def get_shared_weaknesses(team):
+    """Return the number of weaknesses shared by each pair of members"""
+
+    shared = 0
+    for position, candidate in enumerate(team):
+        for other in team[position + 1:]:
+            shared += (candidate.weakness_bitset &
+                       other.weakness_bitset).bit_count()
+
+    return shared
+
+
+def score_team(team):
+    """Return the score of the team, higher is better"""
+
+    return (COVERAGE_WEIGHT * get_coverage(team) -
+            SHARED_WEAKNESS_WEIGHT * get_shared_weaknesses(team))
+
+
+class TeamBitsets():
+    """Types and weakness counts of a team as bitsets. Weakness counts are
+       bit-sliced: bit n of counts[k] is bit k of the number of members weak
+       to type n. The weaknesses a candidate shares with all members then
+       take one AND per slice instead of one per member.
+    """
+
+    def __init__(self, team=()):
+        self.type_bitset = 0
+        self.counts = [0, 0, 0, 0]
+        for member in team:
+            self.add(member)
+
+    def add(self, member):
+        """Add a member to the team"""
+
+        self.type_bitset |= member.type_bitset
+
+        # Add 1 to the count of each weakness, carrying to the next slice
+        carry = member.weakness_bitset
+        for k, count in enumerate(self.counts):
+            self.counts[k] = count ^ carry
+            carry &= count
+
+    def score_addition(self, candidate):
+        """Return the change in score from adding the candidate to the team"""
+
+        weakness_bitset = candidate.weakness_bitset
+        counts = self.counts
+        shared = ((counts[0] & weakness_bitset).bit_count() +
+                  2 * (counts[1] & weakness_bitset).bit_count() +
+                  4 * (counts[2] & weakness_bitset).bit_count() +
+                  8 * (counts[3] & weakness_bitset).bit_count())
+
+        return (COVERAGE_WEIGHT * (candidate.type_bitset &
+                                   ~self.type_bitset).bit_count() -
+                SHARED_WEAKNESS_WEIGHT * shared)
+
+
+class TeamOptimizer():
+    """Bitsets of the types and weaknesses of every pokemon, loaded with a
+       single query and kept until the catalog changes, or for max_age
+       seconds to pick up changes made by other worker processes
+    """
+
+    def __init__(self, max_age=30):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Load the bitsets from the database again on the next search"""
+
+        with self.lock:
+            self.loaded = 0
+            self.pokemon = {}
+
+    def load(self, session):
+        """Load the bitsets and legendary and mythical status of all pokemon"""
+
+        rows = session.query(Pokemon.id, Pokemon.type_list,
+                             Pokemon.weakness_list, Pokemon.is_legendary,
+                             Pokemon.is_mythical)
+
+        # ID: (type bitset, weakness bitset, is legendary, is mythical)
+        pokemon = {}
+        for id, type_list, weakness_list, is_legendary, is_mythical in rows:
+            pokemon[id] = (make_bitset(type_list), make_bitset(weakness_list),
+                           is_legendary, is_mythical)
+
+        with self.lock:
+            self.pokemon = pokemon
+            self.loaded = time.time()
+
+    def get_candidates(self, required_ids, excluded_type_ids,
+                       allow_legendary, allow_mythical):
+        """Group the pokemon meeting the constraints by types and weaknesses
+
+           Return value: (required, candidates): Candidate of each required
+               pokemon in order, and of the other allowed pokemon
+        """
+
+        pokemon = self.pokemon
+        excluded_bitset = make_bitset(excluded_type_ids)
+        required_set = set(required_ids)
+
+        groups = {}
+        for id in sorted(pokemon):
+            type_bitset, weakness_bitset, is_legendary, is_mythical = (
+                pokemon[id])
+            if id not in required_set:
+                if type_bitset & excluded_bitset:
+                    continue
+                if is_legendary and not allow_legendary:
+                    continue
+                if is_mythical and not allow_mythical:
+                    continue
+
+            key = (type_bitset, weakness_bitset)
+            if key not in groups:
+                groups[key] = Candidate(type_bitset, weakness_bitset)
+            groups[key].ids.append(id)
+
+        # Required pokemon are taken out of their groups
+        required = []
+        for id in required_ids:
+            type_bitset, weakness_bitset = pokemon[id][:2]
+            group = groups[(type_bitset, weakness_bitset)]
+            group.ids.remove(id)
+            candidate = Candidate(type_bitset, weakness_bitset)
+            candidate.ids.append(id)
+            required.append(candidate)
+
+        candidates = [group for group in groups.values() if group.ids]
+        return required, candidates
+
+    def optimize(self, session, size=DEFAULT_TEAM_SIZE, required_ids=(),
+                 excluded_type_ids=(), allow_legendary=True,
+                 allow_mythical=True, time_budget=DEFAULT_TIME_BUDGET):
+        """Search for the team with the best score meeting the constraints
+
+           Args: size (int): Number of members
+                 required_ids (list): Pokemon IDs that must be members
+                 excluded_type_ids (list): Type IDs no other member may have
+                 allow_legendary, allow_mythical (bool): Whether other members
+                     may be legendary or mythical
+                 time_budget (int): Milliseconds the search may take
+           Return value: (dict): Ex. {'ids': [4, 7, 1], 'coverage': 5,
+               'shared_weaknesses': 1, 'complete': True}. complete is False
+               when the time budget ran out while swaps still improved the
+               team.
+        """
+
+        deadline = time.perf_counter() + time_budget / 1000.0
+
+        if time.time() - self.loaded > self.max_age:
+            self.load(session)
+
+        required_ids = list(dict.fromkeys(required_ids))
+        missing = [id for id in required_ids if id not in self.pokemon]
+        if missing:
+            raise TeamError('No pokemon with ID %s.' % missing[0])
+        if len(required_ids) > size:
+            raise TeamError('More required pokemon than team members.')
+
+        required, candidates = self.get_candidates(
+            required_ids, excluded_type_ids, allow_legendary, allow_mythical)
+
+        # Greedy construction: add the candidate improving the score most
+        team = list(required)
+        team_bitsets = TeamBitsets(team)
+        while len(team) < size:
+            best = None
+            best_gain = None
+            for candidate in candidates:
+                if candidate.used == len(candidate.ids):
+                    continue
+                gain = team_bitsets.score_addition(candidate)
+                if best_gain is None or gain > best_gain:
+                    best, best_gain = candidate, gain
+
+            if best is None:
+                raise TeamError('Not enough pokemon meet the constraints.')
+
+            team.append(best)
+            team_bitsets.add(best)
+            best.used += 1
+
+        # Hill climbing: swap a member for the candidate improving the score
+        # most until no swap helps or time runs out
+        complete = False
+        timed_out = False
+        best_score = score_team(team)
+        while not timed_out:
+            improved = False
+            for position in range(len(required), size):
+                others = team[:position] + team[position + 1:]
+                others_bitsets = TeamBitsets(others)
+                others_score = score_team(others)
+                current = team[position]
+
+                for number, candidate in enumerate(candidates):
+                    if (number % CHECK_TIME_EVERY == 0 and
+                            time.perf_counter() >= deadline):
+                        timed_out = True
+                        break
+                    if (candidate is current or
+                            candidate.used == len(candidate.ids)):
+                        continue
+
+                    score = (others_score +
+                             others_bitsets.score_addition(candidate))
+                    if score > best_score:
+                        current.used -= 1
+                        candidate.used += 1
+                        team[position] = current = candidate
+                        best_score = score
+                        improved = True
+
+                if timed_out:
+                    break
+
+            if not improved and not timed_out:
+                complete = True
+                break
+
+        # Give each member of a group a different pokemon of the group
+        taken = {}
+        ids = []
+        for position, candidate in enumerate(team):
+            if position < len(required):
+                ids.append(candidate.ids[0])
+            else:
+                index = taken.get(candidate, 0)
+                ids.append(candidate.ids[index])
+                taken[candidate] = index + 1
+
+        return {'ids': ids,
+                'coverage': get_coverage(team),
+                'shared_weaknesses': get_shared_weaknesses(team),
+                'complete': complete}
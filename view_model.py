@@ -1,6 +1,9 @@
 # VIEW_MODEL.PY provides helper functions and classes for the Pokemon Types app
 
-from database_setup import Pokemon, Type, Move, Category
+import string
+from sqlalchemy import asc, desc, false, true, func, or_
+from database_setup import Pokemon, PokemonDisplay, Type, Move, Category, User
+from column_types import integer_list_contains
 
 
 #
@@ -18,6 +21,31 @@ def get_height_for_display(height_num):
     return height_string
 
 
+#
+# NAME LOOKUP FUNCTIONS
+#
+def get_names_by_key(key_column, name_column, key_list, session):
+    """Look up the names of all the keys with a single query, so the number
+       of queries does not grow with the length of the list
+
+       Args: key_column, name_column: Ex. Type.id, Type.name
+             key_list (list): Ex. [12, 3]
+       Return value: (dict): Ex. {12: 'Fire', 3: 'Water'}
+    """
+
+    keys = set(key for key in key_list if key not in (None, ''))
+    if not keys:
+        return {}
+
+    names = {}
+    for key, name in session.query(key_column, name_column).filter(
+            key_column.in_(keys)):
+        # Keep the first match like a lookup with first() would
+        names.setdefault(key, name)
+
+    return names
+
+
 #
 # POKEMON NAME FUNCTIONS
 #
@@ -41,9 +69,16 @@ def get_pokemon_name_list(pokemon_id_list, session):
     pokemon_list = []
 
     if pokemon_id_list:
+        names = get_names_by_key(Pokemon.pokedex_id, Pokemon.name,
+                                 [int(item) for item in pokemon_id_list],
+                                 session)
         for pokedex_id in pokemon_id_list:
-            name = get_pokemon_name(pokedex_id, session)
-            pokemon_list.append(name)
+            if not pokedex_id:
+                pokemon_list.append('')
+            else:
+                pokemon_list.append(names.get(
+                    int(pokedex_id),
+                    'Pokemon with Pokedex ID# %s' % pokedex_id))
 
     return pokemon_list
 
@@ -68,11 +103,10 @@ def get_type_name_list(type_id_list, session):
     type_list = []
 
     if type_id_list:
+        names = get_names_by_key(Type.id, Type.name, type_id_list, session)
         for id in type_id_list:
-            type = session.query(Type).filter_by(id=id).first()
-
-            if type:
-                type_list.append(type.name)
+            if id in names:
+                type_list.append(names[id])
 
     return type_list
 
@@ -108,11 +142,10 @@ def get_move_name_list(move_id_list, session):
     move_list = []
 
     if move_id_list:
+        names = get_names_by_key(Move.id, Move.name, move_id_list, session)
         for id in move_id_list:
-            move = session.query(Move).filter_by(id=id).first()
-
-            if move:
-                move_list.append(move.name)
+            if id in names:
+                move_list.append(names[id])
 
     return move_list
 
@@ -144,6 +177,353 @@ def get_user_id(email, session):
         return None
 
 
+#
+# POKEMON FILTER FUNCTIONS
+#
+
+# Columns the pokemon listings may be sorted by with the sort= parameter.
+# A "-" prefix sorts in descending order. Ex. sort=-weight
+SORT_COLUMNS = {
+    'pokedex_id': Pokemon.pokedex_id,
+    'name': Pokemon.name,
+    'height': Pokemon.height,
+    'weight': Pokemon.weight
+    }
+
+# Values of the legendary= and mythical= parameters
+TRUE_VALUES = ['1', 'true', 'yes', 'on']
+FALSE_VALUES = ['0', 'false', 'no', 'off']
+
+
+def parse_pokemon_filters(args):
+    """Get the pokemon filters from the request parameters. Parameters with
+       invalid values are ignored.
+
+       Args: args (dict): Request parameters. Ex. {'legendary': 'true',
+             'type': 'dragon', 'min_weight': '220', 'sort': 'height'}
+       Return value: filters (dict): The given filters converted to the types
+           stored in the database. Heights are in inches, weights in lbs.
+    """
+
+    filters = {}
+
+    for name in ['legendary', 'mythical']:
+        value = args.get(name, '').strip().lower()
+        if value in TRUE_VALUES:
+            filters[name] = True
+        elif value in FALSE_VALUES:
+            filters[name] = False
+
+    for name, convert in [('min_weight', float), ('max_weight', float),
+                          ('min_height', int), ('max_height', int)]:
+        try:
+            filters[name] = convert(args[name])
+        except (KeyError, ValueError):
+            continue
+
+    for name in ['category', 'move']:
+        if args.get(name, '').strip():
+            filters[name] = string.capwords(args[name].strip())
+
+    # Pokemon must have all the given types
+    types = [string.capwords(item.strip())
+             for item in args.get('type', '').split(',') if item.strip()]
+    if types:
+        filters['types'] = types
+
+    sort = args.get('sort', '')
+    if sort.lstrip('-') in SORT_COLUMNS:
+        filters['sort'] = sort
+
+    return filters
+
+
+def filter_pokemon(query, filters, session):
+    """Add the filters to a query involving the Pokemon table. All filtering
+       is done by the database.
+
+       Args: query (Query): Query selecting from or joined to Pokemon
+             filters (dict): Filters from parse_pokemon_filters
+       Return value: (Query): The filtered query
+    """
+
+    if 'legendary' in filters:
+        query = query.filter(Pokemon.is_legendary == filters['legendary'])
+    if 'mythical' in filters:
+        query = query.filter(Pokemon.is_mythical == filters['mythical'])
+
+    if 'min_weight' in filters:
+        query = query.filter(Pokemon.weight >= filters['min_weight'])
+    if 'max_weight' in filters:
+        query = query.filter(Pokemon.weight <= filters['max_weight'])
+    if 'min_height' in filters:
+        query = query.filter(Pokemon.height >= filters['min_height'])
+    if 'max_height' in filters:
+        query = query.filter(Pokemon.height <= filters['max_height'])
+
+    # Names not found in the database match no pokemon
+    if 'category' in filters:
+        category_id = get_category_id(filters['category'], session)
+        if category_id is None:
+            query = query.filter(false())
+        else:
+            query = query.filter(Pokemon.category_id == category_id)
+
+    if 'move' in filters:
+        move_id = get_move_id(filters['move'], session)
+        if move_id is None:
+            query = query.filter(false())
+        else:
+            query = query.filter(
+                integer_list_contains(Pokemon.move_list, move_id))
+
+    for type_name in filters.get('types', []):
+        type_id = get_type_id(type_name, session)
+        if type_id is None:
+            query = query.filter(false())
+        else:
+            query = query.filter(
+                integer_list_contains(Pokemon.type_list, type_id))
+
+    return query
+
+
+def sort_pokemon(query, filters):
+    """Add the sort order from the filters to a query involving the Pokemon
+       table. Pokemon are sorted by Pokedex ID by default.
+    """
+
+    # The ID keeps the order stable
+    sort = filters.get('sort', 'pokedex_id')
+    if sort.startswith('-'):
+        query = query.order_by(desc(SORT_COLUMNS[sort[1:]]))
+    else:
+        query = query.order_by(asc(SORT_COLUMNS[sort]))
+
+    return query.order_by(asc(Pokemon.id))
+
+
+#
+# FACET FUNCTIONS
+#
+def get_facet_counts(filters, session):
+    """Count the pokemon matching the filters per type, weakness, category
+       and legendary and mythical status. The counts are computed by the
+       database with two aggregate queries.
+
+       Return value: facets (dict): Ex. {'total': 3, 'legendary': 0,
+           'mythical': 0, 'types': {'Fire': 1, ...}, 'weaknesses':
+           {'Water': 1, ...}, 'categories': {'Lizard': 1, ...}}
+    """
+
+    types = session.query(Type).order_by(asc(Type.name)).all()
+
+    # Status and per type counts in a single pass over the pokemon
+    counts = [func.count(),
+              func.count().filter(Pokemon.is_legendary == true()),
+              func.count().filter(Pokemon.is_mythical == true())]
+    for type in types:
+        counts.append(func.count().filter(
+            integer_list_contains(Pokemon.type_list, type.id)))
+    for type in types:
+        counts.append(func.count().filter(
+            integer_list_contains(Pokemon.weakness_list, type.id)))
+
+    row = filter_pokemon(session.query(*counts).select_from(Pokemon),
+                         filters, session).one()
+
+    type_counts = row[3:3 + len(types)]
+    weakness_counts = row[3 + len(types):]
+
+    category_counts = filter_pokemon(
+        session.query(Category.name, func.count(Pokemon.id)).join(
+            Pokemon, Pokemon.category_id == Category.id),
+        filters, session).group_by(Category.name).order_by(asc(Category.name))
+
+    return {
+        'total': row[0],
+        'legendary': row[1],
+        'mythical': row[2],
+        'types': dict((type.name, count)
+                      for type, count in zip(types, type_counts)),
+        'weaknesses': dict((type.name, count)
+                           for type, count in zip(types, weakness_counts)),
+        'categories': dict((name, count) for name, count in category_counts)
+        }
+
+
+#
+# SERIALIZED FIELD FUNCTIONS
+#
+
+# Fields of the serialized view model, each with the view model property
+# producing it
+SERIALIZE_FIELDS = [
+    ('id', 'id'),
+    ('name', 'name'),
+    ('pokedex_id', 'pokedex_id'),
+    ('description', 'description'),
+    ('image', 'image'),
+    ('height', 'height'),
+    ('weight', 'weight'),
+    ('is_mythical', 'is_mythical'),
+    ('is_legendary', 'is_legendary'),
+    ('evolves_from', 'evolution_before'),
+    ('evolves_to', 'evolutions_after'),
+    ('types', 'types'),
+    ('weaknesses', 'weaknesses'),
+    ('moves', 'moves'),
+    ('category', 'category')
+    ]
+
+# Serialized fields holding lists that are displayed as comma-separated text
+LIST_FIELDS = ['evolves_to', 'types', 'weaknesses', 'moves']
+
+
+def parse_field_list(field_input):
+    """Get the list of serialized fields from the comma-separated input
+
+       Args: field_input (str): Requested field names. Ex. "name,types"
+       Return value: field_list (list): Field names in serialized order,
+           always including 'id', or None if no field was requested
+       Raises ValueError if a requested field does not exist
+    """
+
+    requested = set(item.strip().lower() for item in field_input.split(',')
+                    if item.strip())
+
+    fields = [field for field, _ in SERIALIZE_FIELDS]
+    unknown = sorted(requested.difference(fields))
+    if unknown:
+        raise ValueError('Unknown fields: %s.' % ', '.join(unknown))
+
+    field_list = [field for field in fields if field in requested]
+    if not field_list:
+        return None
+
+    if 'id' not in field_list:
+        field_list.insert(0, 'id')
+
+    return field_list
+
+
+def get_display_columns(field_list):
+    """Return the PokemonDisplay table columns holding the given fields"""
+
+    return [getattr(PokemonDisplay, field) for field in field_list]
+
+
+def serialize_display(display, field_list=None):
+    """For JSON API endpoints showing pokemon entries from the display table
+
+       Args: display (PokemonDisplay): Display row of a pokemon
+             field_list (list): Fields to include or None for all
+    """
+
+    if field_list is None:
+        field_list = [field for field, _ in SERIALIZE_FIELDS]
+
+    return dict((field, getattr(display, field)) for field in field_list)
+
+
+def serialize_details(details, field_list=None):
+    """For JSON API endpoints showing pokemon entries from cached details
+
+       Args: details (dict): Details of a pokemon, from serialize_display
+             field_list (list): Fields to include or None for all
+    """
+
+    if field_list is None:
+        field_list = [field for field, _ in SERIALIZE_FIELDS]
+
+    return dict((field, details[field]) for field in field_list)
+
+
+#
+# POKEMON DISPLAY FUNCTIONS
+#
+def refresh_pokemon_display(pokemon, session):
+    """Write the display row of the pokemon in the current transaction"""
+
+    display = session.query(PokemonDisplay).filter_by(id=pokemon.id).first()
+
+    return write_pokemon_display(pokemon, display, session)
+
+
+def refresh_pokemon_displays(pokemon_list, session):
+    """Write the display rows of the pokemon in the current transaction,
+       reading their current display rows with a single query
+    """
+
+    displays = {}
+    if pokemon_list:
+        displays = dict((display.id, display) for display in session.query(
+            PokemonDisplay).filter(PokemonDisplay.id.in_(
+                [pokemon.id for pokemon in pokemon_list])))
+
+    for pokemon in pokemon_list:
+        write_pokemon_display(pokemon, displays.get(pokemon.id), session)
+
+
+def write_pokemon_display(pokemon, display, session):
+    """Copy the details of the pokemon to its display row, adding the row if
+       display is None
+    """
+
+    view_model = Pokemon_VM(pokemon, session)
+
+    if display is None:
+        display = PokemonDisplay(id=pokemon.id)
+        session.add(display)
+
+    for field, value in view_model.serialize.items():
+        setattr(display, field, value)
+    display.user = view_model.user
+    display.user_id = pokemon.user_id
+
+    return display
+
+
+def get_evolution_dependents(pokedex_id_list, session):
+    """Return the pokemon whose evolutions refer to any of the Pokedex IDs.
+       Their display rows show the names of those pokemon. The database
+       finds them from the indexes on the evolution columns.
+    """
+
+    pokedex_ids = set()
+    for item in pokedex_id_list:
+        try:
+            pokedex_ids.add(int(item))
+        except (TypeError, ValueError):
+            continue
+    if not pokedex_ids:
+        return []
+
+    pokedex_ids = sorted(pokedex_ids)
+    conditions = [Pokemon.evolution_before.in_(pokedex_ids)]
+    conditions.extend(integer_list_contains(Pokemon.evolution_after_list, id)
+                      for id in pokedex_ids)
+
+    return session.query(Pokemon).filter(or_(*conditions)).all()
+
+
+def refresh_evolution_displays(pokedex_id_list, session):
+    """Refresh the display rows showing the names of the pokemon with the
+       given Pokedex IDs, after those pokemon were added, renamed or deleted
+    """
+
+    for pokemon in get_evolution_dependents(pokedex_id_list, session):
+        refresh_pokemon_display(pokemon, session)
+
+
+def rebuild_pokemon_displays(session):
+    """Write the display rows of all pokemon in the current transaction"""
+
+    session.query(PokemonDisplay).delete()
+    for pokemon in session.query(Pokemon).all():
+        refresh_pokemon_display(pokemon, session)
+
+
 #
 # DATA VIEW MODEL
 #
@@ -183,20 +563,11 @@ class Pokemon_VM():
     def serialize(self):
         """For JSON API endpoint showing the pokemon entries in the database"""
 
-        return {
-            'id': self.id,
-            'name': self.name,
-            'pokedex_id': self.pokedex_id,
-            'description': self.description,
-            'image': self.image,
-            'height': self.height,
-            'weight': self.weight,
-            'is_mythical': self.is_mythical,
-            'is_legendary': self.is_legendary,
-            'evolves_from': self.evolution_before,
-            'evolves_to': ', '.join(self.evolutions_after),
-            'types': ', '.join(self.types),
-            'weaknesses': ', '.join(self.weaknesses),
-            'moves': ', '.join(self.moves),
-            'category': self.category
-            }
+        serialized = {}
+        for field, property_name in SERIALIZE_FIELDS:
+            value = getattr(self, property_name)
+            if field in LIST_FIELDS:
+                value = ', '.join(value)
+            serialized[field] = value
+
+        return serialized
@@ -0,0 +1,85 @@
+# WRITE_QUEUE.PY runs the requests of the Pokemon Types app that write to the
+# database one at a time on a dedicated writer thread. SQLite allows a single
+# writer, so concurrent form posts would otherwise fail with "database is
+# locked" once its busy timeout runs out. Reads keep running in parallel on
+# the request threads.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from flask import request, copy_current_request_context
+
+
+# Requests with these methods only read and are never queued
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class WriteQueue():
+    """Runs units of work on a single writer thread, in the order queued.
+       When disabled, ex. on PostgreSQL, which handles concurrent writers,
+       they run on the calling thread instead.
+    """
+
+    def __init__(self, enabled=True, on_done=None):
+        self.enabled = enabled
+        # Called on the writer thread after each unit of work, ex. to drop
+        # the session it used
+        self.on_done = on_done
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='writer')
+        self.writer_ident = None
+
+    def is_writer_thread(self):
+        """Check if called from the writer thread"""
+
+        return threading.get_ident() == self.writer_ident
+
+    def run_queued(self, function, *args, **kwargs):
+        """Run the function on the writer thread, remembering the thread"""
+
+        self.writer_ident = threading.get_ident()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if self.on_done is not None:
+                self.on_done()
+
+    def run(self, function, *args, **kwargs):
+        """Run the function on the writer thread and return its result.
+           Exceptions it raises are raised again here.
+        """
+
+        if not self.enabled or self.is_writer_thread():
+            return function(*args, **kwargs)
+
+        return self.executor.submit(self.run_queued, function, *args,
+                                    **kwargs).result()
+
+
+def queued_write(write_queue):
+    """Decorator for views whose requests other than GET and HEAD write to
+       the database. Those requests run on the writer thread with a copy of
+       the request context, so the view sees the same request and session.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def queued_view(*args, **kwargs):
+            if request.method in SAFE_METHODS or not write_queue.enabled:
+                return view(*args, **kwargs)
+
+            return write_queue.run(copy_current_request_context(view),
+                                   *args, **kwargs)
+
+        return queued_view
+
+    return decorator
+
+
+def is_read_only_request(write_queue):
+    """Check if the current request only reads from the database, so it may
+       use a read-only connection
+    """
+
+    return (request.method in SAFE_METHODS and
+            not write_queue.is_writer_thread())